@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+#   bench_compression.py [RUNS]
+#
+# Fetches generated configs of several sizes from a local ConfigServer with
+# cache_config.py, with the server's compression off and on, and reports the
+# body bytes sent over the wire and the median wall time of RUNS fetches
+# (default 5). Every fetch is a cache miss: the cache TTL is 0.
+
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from config_server import ConfigServer, generateConfig
+
+
+################################################################################
+# GLOBALS
+################################################################################
+
+CACHE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache_config.py')
+
+SIZES = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def fetch(cache_file, url, extra_args=[]):
+    '''Run cache_config.py once against url. Returns the wall time taken.'''
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        subprocess.check_call([sys.executable, CACHE_CONFIG] + extra_args +
+                              [cache_file, '0', '30', url], stdout=devnull)
+        return time.time() - start
+    finally:
+        devnull.close()
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def benchmark(size, compress, runs, extra_args=[]):
+    '''Return the bytes sent per fetch and the median fetch time for a config
+    of size bytes.'''
+    workdir = tempfile.mkdtemp()
+    server  = ConfigServer(generateConfig(size), compress)
+    server.start()
+    try:
+        cache_file = os.path.join(workdir, 'cached_config')
+        times = [fetch(cache_file, server.url(), extra_args) for i in range(runs)]
+        return server.bytesSent // server.requests, median(times)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    runs = 5
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    print "%-10s %-22s %14s %12s" % ("size", "mode", "wire bytes", "median s")
+    for size in SIZES:
+        for label, compress, extra_args in [("identity", False, []),
+                                            ("compressed", True, []),
+                                            ("compressed, gz cache", True, ['--compress-cache'])]:
+            wire, wall = benchmark(size, compress, runs, extra_args)
+            print "%-10d %-22s %14d %12.3f" % (size, label, wire, wall)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+#   bench_jitter.py [HOSTS] [TTL] [CALL_INTERVAL]
+#
+# Simulates HOSTS hosts (default 1000) whose caches were all written at the
+# same moment, each reading its config on average every CALL_INTERVAL
+# seconds (default 10), for four cache TTLs of TTL seconds (default 300).
+# Every read decides whether to refresh with cache_config's own
+# CacheConfigFile.hasExpired(), with and without --ttl-jitter and
+# --early-refresh, and the requests the config server would see are counted.
+# Reported are the total requests and the peak requests in any one second
+# and in any ten seconds. No server or files are needed.
+
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import sys
+import heapq
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cache_config_lib import CacheConfigFile
+
+
+################################################################################
+# GLOBALS
+################################################################################
+
+SEED = 1
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def simulate(hosts, ttl, call_interval, ttl_jitter, early_refresh):
+    '''Return the number of requests made to the config server in each
+    second of the simulation.'''
+    random.seed(SEED)
+    duration = 4 * ttl
+    written  = [0.0] * hosts
+    requests = [0] * duration
+    calls    = [(random.expovariate(1.0 / call_interval), host) for host in range(hosts)]
+    heapq.heapify(calls)
+    while calls:
+        now, host = heapq.heappop(calls)
+        if now >= duration:
+            continue
+        # Each read is a new cache_config process, so a new CacheConfigFile.
+        cache_config_file = CacheConfigFile('/host%d/cached_config' % host, ttl,
+                                            ttl_jitter, early_refresh)
+        if cache_config_file.hasExpired(now - written[host]):
+            written[host] = now
+            requests[int(now)] += 1
+        heapq.heappush(calls, (now + random.expovariate(1.0 / call_interval), host))
+    return requests
+
+
+def peak(requests, window):
+    '''Return the most requests made in any window seconds.'''
+    return max([sum(requests[i:i + window]) for i in range(len(requests) - window + 1)])
+
+
+if __name__ == "__main__":
+    hosts         = 1000
+    ttl           = 300
+    call_interval = 10.0
+    if len(sys.argv) > 1:
+        hosts = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        ttl = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        call_interval = float(sys.argv[3])
+
+    print "%d hosts, TTL %ds, a read every %.0fs on average" % (hosts, ttl, call_interval)
+    print "%-36s %10s %10s %10s" % ("mode", "requests", "peak/1s", "peak/10s")
+    for label, ttl_jitter, early_refresh in [
+            ("fixed TTL", 0.0, None),
+            ("--ttl-jitter=0.2", 0.2, None),
+            ("--early-refresh (TTL/10)", 0.0, ttl / 10.0),
+            ("--ttl-jitter=0.2 --early-refresh", 0.2, ttl / 10.0)]:
+        requests = simulate(hosts, ttl, call_interval, ttl_jitter, early_refresh)
+        print "%-36s %10d %10d %10d" % (label, sum(requests), peak(requests, 1), peak(requests, 10))
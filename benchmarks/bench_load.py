@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+#   bench_load.py [CALLERS] [CALLS] [SCENARIO ...]
+#
+# Runs CALLERS concurrent callers (default 8), each running cache_config.py
+# CALLS times in a row (default 10) against one shared cache file, the way
+# the condor_* commands and daemons on a busy host do, for each of the
+# SCENARIOS below (default all). The config comes from a local ConfigServer
+# set up for the scenario, so no CycleServer is needed.
+#
+# For each scenario it reports the calls made per second, the 50th, 90th and
+# 99th percentiles of call time, the 99th percentile and total of the time
+# callers spent waiting on the cache lock (from --metrics records), the
+# requests the config server answered and the calls that failed. The "hit"
+# scenario runs without --metrics, which would take every call the slow way
+# through cache_config_lib, so it measures the fast path and shows no lock
+# waits.
+
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from config_server import ConfigServer, generateConfig
+
+
+################################################################################
+# GLOBALS
+################################################################################
+
+CACHE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache_config.py')
+
+# name, routes tried in order, cache TTL, extra cache_config.py arguments and
+# ConfigServer settings
+SCENARIOS = [
+    ("hit",          ["success"],                 3600, [], {}),
+    ("miss",         ["success"],                 0,    [], {}),
+    ("expiring",     ["success"],                 1,    [], { 'latency' : 0.2 }),
+    ("not_modified", ["not_modified"],            0,    [], {}),
+    ("large",        ["success"],                 0,    [], { 'size' : 4 * 1024 * 1024 }),
+    ("failover",     ["error", "success"],        0,    [], {}),
+    ("flaky",        ["success", "success"],      0,    [], { 'failure_rate' : 0.3 }),
+    ("timeout",      ["timeout", "success"],      0,    ['--read-timeout=1',
+                                                         '--circuit-breaker'], {}),
+    ("race",         ["timeout", "success"],      0,    ['--race'], {}),
+]
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def percentile(values, p):
+    '''Return the pth percentile of values, by nearest rank.'''
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[max(0, (p * len(values) + 99) // 100 - 1)]
+
+
+def caller(args, calls, times, failures):
+    '''Run args calls times in a row, adding each wall time to times and
+    each failed call to failures.'''
+    devnull = open(os.devnull, 'w')
+    try:
+        for i in range(calls):
+            start  = time.time()
+            status = subprocess.call(args, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+            if status != 0:
+                failures.append(status)
+    finally:
+        devnull.close()
+
+
+def readMetrics(metrics_file):
+    '''Return the lock waits recorded in a --metrics file.'''
+    waits = []
+    fp = open(metrics_file, 'r')
+    try:
+        for line in fp:
+            waits.append(json.loads(line)['lock_wait'])
+    finally:
+        fp.close()
+    return waits
+
+
+def benchmark(scenario, callers, calls):
+    '''Run one of the SCENARIOS. Returns the wall time, call times, lock
+    waits, origin requests and failed calls.'''
+    name, routes, ttl, extra_args, settings = scenario
+    settings = settings.copy()
+    size     = settings.pop('size', 16 * 1024)
+    workdir  = tempfile.mkdtemp()
+    server   = ConfigServer(generateConfig(size), **settings)
+    server.start()
+    try:
+        cache_file   = os.path.join(workdir, 'cached_config')
+        metrics_file = os.path.join(workdir, 'metrics')
+        args = [sys.executable, CACHE_CONFIG] + extra_args + [cache_file, str(ttl), '30'] + \
+               [server.url('/' + route) for route in routes]
+        if ttl > 0:
+            # Seed the cache so the callers start with a fresh one.
+            caller(args, 1, [], [])
+        server.reset()
+
+        if name != "hit":
+            args.insert(2, '--metrics=' + metrics_file)
+        times    = []
+        failures = []
+        threads  = [threading.Thread(target=caller, args=(args, calls, times, failures))
+                    for i in range(callers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.time() - start
+        waits = []
+        if os.path.exists(metrics_file):
+            waits = readMetrics(metrics_file)
+        return wall, times, waits, server.originRequests(), len(failures)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    callers = 8
+    calls   = 10
+    if len(sys.argv) > 1:
+        callers = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        calls = int(sys.argv[2])
+    chosen = sys.argv[3:]
+
+    print "%d callers x %d calls" % (callers, calls)
+    print "%-13s %8s %8s %8s %8s %9s %9s %7s %6s" % \
+            ("scenario", "calls/s", "p50 ms", "p90 ms", "p99 ms",
+             "lock p99", "lock sum", "origin", "failed")
+    for scenario in SCENARIOS:
+        if chosen and scenario[0] not in chosen:
+            continue
+        wall, times, waits, origin, failed = benchmark(scenario, callers, calls)
+        print "%-13s %8.1f %8.1f %8.1f %8.1f %9.1f %9.2f %7d %6d" % \
+                (scenario[0], len(times) / wall,
+                 percentile(times, 50) * 1000, percentile(times, 90) * 1000,
+                 percentile(times, 99) * 1000, percentile(waits, 99) * 1000, sum(waits),
+                 origin, failed)
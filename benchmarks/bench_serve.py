@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+#   bench_serve.py [RUNS]
+#
+# Times writing a cached config of several sizes to HTCondor's end of the
+# pipe, the last step of every cache_config run, both ways cache_config can
+# do it: from a memory map with sendCache() and through the chunked copy
+# that compressed caches and caches with carriage returns still take.
+# Output goes to /dev/null and to a pipe read by another process. The median
+# of RUNS writes (default 20) is reported, in milliseconds.
+
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cache_config_common import sendCache
+from cache_config_lib import writeToFile, openCache
+from config_server import generateConfig
+
+
+################################################################################
+# GLOBALS
+################################################################################
+
+SIZES = [4 * 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024, 64 * 1024 * 1024]
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def mapped(file_name, out_fp):
+    if not sendCache(file_name, out_fp):
+        raise Exception("%s cannot be sent from a memory map" % file_name)
+
+
+def chunked(file_name, out_fp):
+    writeToFile(openCache(file_name), out_fp)
+
+
+def timeWrites(write, file_name, out_fp, runs):
+    '''Return the median time write() takes to write file_name to out_fp.'''
+    times = []
+    for i in range(runs):
+        start = time.time()
+        write(file_name, out_fp)
+        out_fp.flush()
+        times.append(time.time() - start)
+    return median(times)
+
+
+if __name__ == "__main__":
+    runs = 20
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    workdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    reader  = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=devnull)
+    try:
+        print "%-10s %-10s %12s %12s %8s" % ("size", "output", "chunked ms", "mmap ms", "speedup")
+        for size in SIZES:
+            file_name = os.path.join(workdir, 'cached_config')
+            fp = open(file_name, 'w')
+            fp.write(generateConfig(size))
+            fp.close()
+            for label, out_fp in [("/dev/null", devnull), ("pipe", reader.stdin)]:
+                old = timeWrites(chunked, file_name, out_fp, runs)
+                new = timeWrites(mapped, file_name, out_fp, runs)
+                print "%-10d %-10s %12.3f %12.3f %7.1fx" % \
+                        (size, label, old * 1000, new * 1000, old / new)
+    finally:
+        reader.stdin.close()
+        reader.wait()
+        devnull.close()
+        shutil.rmtree(workdir)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+#   bench_startup.py [RUNS] [BASELINE_SCRIPT]
+#
+# Times whole invocations of cache_config.py, the way HTCondor runs it, for a
+# cache hit (a fresh cache file) and a cache miss (TTL 0, fetched from a
+# local ConfigServer). "cold" is the first run against a freshly copied
+# script and cache directory, with its modules not yet compiled; "warm" is
+# the median of the next RUNS runs (default 20), with the modules compiled
+# as installing does. The time to start an interpreter that does nothing is shown
+# for reference.
+#
+# Given BASELINE_SCRIPT, for example an older cache_config.py from git, the
+# same runs are made with it for comparison.
+
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import py_compile
+
+from config_server import ConfigServer, generateConfig
+
+
+################################################################################
+# GLOBALS
+################################################################################
+
+CACHE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache_config.py')
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def timeRun(args):
+    '''Run a command line once with its output discarded. Returns the wall
+    time taken.'''
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        subprocess.check_call(args, stdout=devnull)
+        return time.time() - start
+    finally:
+        devnull.close()
+
+
+def removeCompiled(modules):
+    '''Remove any compiled copies of modules, so the next run compiles them.'''
+    for module in modules:
+        if os.path.exists(module + 'c'):
+            os.remove(module + 'c')
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def benchmark(script, ttl, url, runs):
+    '''Return the cold and warm run times of script with a cache TTL of ttl.'''
+    workdir = tempfile.mkdtemp()
+    try:
+        copy = os.path.join(workdir, 'cache_config.py')
+        shutil.copy(script, copy)
+        modules = []
+        for name in ['cache_config_common.py', 'cache_config_lib.py']:
+            module = os.path.join(os.path.dirname(script), name)
+            if os.path.exists(module):
+                shutil.copy(module, workdir)
+                modules.append(os.path.join(workdir, name))
+        cache_file = os.path.join(workdir, 'cached_config')
+        args = [sys.executable, copy, cache_file, str(ttl), '30', url]
+        if ttl > 0:
+            # Seed the cache so every timed run is a hit.
+            timeRun(args)
+            removeCompiled(modules)
+        cold = timeRun(args)
+        # Warm runs load the .pyc files installing compiles, which a run
+        # does not write itself under PYTHONDONTWRITEBYTECODE.
+        for module in modules:
+            py_compile.compile(module, doraise=True)
+        warm = median([timeRun(args) for i in range(runs)])
+        return cold, warm
+    finally:
+        shutil.rmtree(workdir)
+
+
+def report(label, script, url, runs):
+    for scenario, ttl in [("hit", 3600), ("miss", 0)]:
+        cold, warm = benchmark(script, ttl, url, runs)
+        print "%-10s %-6s %10.1f %10.1f" % (label, scenario, cold * 1000, warm * 1000)
+
+
+if __name__ == "__main__":
+    runs = 20
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    server = ConfigServer(generateConfig(16 * 1024))
+    server.start()
+    try:
+        empty = median([timeRun([sys.executable, '-c', 'pass']) for i in range(runs)])
+        print "%-10s %-6s %10s %10s" % ("script", "cache", "cold ms", "warm ms")
+        print "%-10s %-6s %10s %10.1f" % ("python", "-", "-", empty * 1000)
+        report("current", CACHE_CONFIG, server.url(), runs)
+        if len(sys.argv) > 2:
+            report("baseline", sys.argv[2], server.url(), runs)
+    finally:
+        server.stop()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+# A stand-in for a config server, for the benchmarks in this directory. It
+# runs in a background thread of the benchmark process:
+#
+#   server = ConfigServer(body)
+#   server.start()
+#   ... run cache_config.py against server.url("/config") ...
+#   server.stop()
+#
+# Like the CycleServer plugins in tests/plugins/cycle/cache_config, it
+# answers by path:
+#
+#   /success, or any other path   the config, sent every time
+#   /not_modified                 the config, or 304 Not Modified when the
+#                                 client's If-None-Match or If-Modified-Since
+#                                 shows it has the copy served from start-up
+#   /error                        500 Internal Server Error
+#   /timeout                      the config, after a wait of TIMEOUT seconds
+#   /watch                        as /not_modified, but a request with
+#                                 "Prefer: wait=SECONDS" for the current copy
+#                                 is held open until publish() changes the
+#                                 config or SECONDS pass
+#
+# Every request can be delayed by a fixed latency, and a share of the
+# requests for the config can fail with 500 at random.
+#
+# Run on its own, it serves a generated config until interrupted:
+#
+#   config_server.py [PORT [BODY_BYTES [LATENCY [FAILURE_RATE]]]]
+
+
+################################################################################
+# IMPORTS
+################################################################################
+
+import sys
+import time
+import zlib
+import random
+import hashlib
+import threading
+import email.utils
+import BaseHTTPServer
+import SocketServer
+
+
+################################################################################
+# CLASSES
+################################################################################
+
+class ConfigRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answer requests for the routes of the ConfigServer that owns this
+    handler.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        '''Keep request logging out of benchmark output.'''
+        pass
+
+    def do_GET(self):
+        config = self.server.config
+        route  = self.path.strip('/').split('/')[0]
+        if route not in config.counts:
+            route = 'success'
+        config.count(route)
+        if config.latency > 0:
+            time.sleep(config.latency)
+
+        if route == 'error' or (route in ('success', 'not_modified', 'watch') and config.fails()):
+            self.sendEmpty(500)
+            return
+        if route == 'timeout':
+            time.sleep(config.timeout)
+        applied = None
+        if route == 'watch':
+            applied = config.waitForChange(self.headers)
+        if route in ('not_modified', 'watch') and config.isCurrent(self.headers):
+            self.sendEmpty(304, applied)
+            return
+        self.sendConfig(applied)
+
+    def sendEmpty(self, code, applied=None):
+        '''Answer with the status code and no body, and the Prefer
+        preference applied, if any.'''
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        if applied != None:
+            self.send_header('Preference-Applied', applied)
+        self.end_headers()
+
+    def sendConfig(self, applied=None):
+        '''Answer with the config, compressed if the client accepts it, and
+        the Prefer preference applied, if any.'''
+        config   = self.server.config
+        encoding = None
+        if config.compress:
+            accepted = [e.split(';')[0].strip() for e in
+                        self.headers.get('Accept-Encoding', '').split(',')]
+            for encoding in ['gzip', 'deflate', None]:
+                if encoding in accepted:
+                    break
+        body, etag, modified = config.encodedBody(encoding)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(modified, usegmt=True))
+        if encoding != None:
+            self.send_header('Content-Encoding', encoding)
+        if applied != None:
+            self.send_header('Preference-Applied', applied)
+        self.end_headers()
+        self.wfile.write(body)
+        config.record(len(body))
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads      = True
+    allow_reuse_address = True
+
+
+class ConfigServer:
+    '''A local HTTP server that answers a GET for the config with body,
+    compressed with gzip or deflate when compress is set and the client
+    accepts it, and the other routes in USAGE as the test plugins do. Each
+    request waits latency seconds first, a /timeout request timeout seconds
+    more, and failure_rate of the requests for the config fail. The config
+    can be changed with publish() while the server runs. Counts the
+    requests for each route, the config bodies it sends and their bytes.'''
+
+    def __init__(self, body, compress=True, port=0, latency=0.0, failure_rate=0.0,
+                 timeout=30.0, seed=1):
+        self.body        = body
+        self.compress    = compress
+        self.encoded     = { None : body }
+        self.etag        = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.modified    = int(time.time())
+        self.latency     = latency
+        self.failureRate = failure_rate
+        self.timeout     = timeout
+        self.random      = random.Random(seed)
+        self.counts      = dict.fromkeys(['success', 'not_modified', 'error', 'timeout',
+                                          'watch'], 0)
+        self.requests    = 0
+        self.bytesSent   = 0
+        self.mutex       = threading.Lock()
+        self.changed     = threading.Condition(self.mutex)
+        self.httpd     = ThreadedHTTPServer(('127.0.0.1', port), ConfigRequestHandler)
+        self.httpd.config = self
+        self.thread    = None
+
+    def encodedBody(self, encoding):
+        '''Return the body with the Content-Encoding encoding applied (None
+        for none), with the ETag and modification time of that copy.
+        Encoded bodies are made once, as a server would cache them, so the
+        benchmarks time the client.'''
+        self.mutex.acquire()
+        try:
+            if not self.encoded.has_key(encoding):
+                if encoding == 'gzip':
+                    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    self.encoded[encoding] = compressor.compress(self.body) + compressor.flush()
+                else:
+                    self.encoded[encoding] = zlib.compress(self.body, 6)
+            return self.encoded[encoding], self.etag, self.modified
+        finally:
+            self.mutex.release()
+
+    def publish(self, body):
+        '''Replace the config with body, answering the /watch requests held
+        open for the old one.'''
+        self.mutex.acquire()
+        try:
+            self.body     = body
+            self.encoded  = { None : body }
+            self.etag     = '"%s"' % hashlib.sha1(body).hexdigest()
+            # Last-Modified has whole seconds, so each copy gets a later one.
+            self.modified = max(int(time.time()), self.modified + 1)
+            self.changed.notifyAll()
+        finally:
+            self.mutex.release()
+
+    def waitForChange(self, headers):
+        '''Hold a request with "Prefer: wait=SECONDS" in its headers, from a
+        client that has the current config, until publish() changes it or
+        SECONDS pass. Returns the preference applied, or None if there was
+        none.'''
+        prefer = headers.get('Prefer', '').strip()
+        if not prefer.startswith('wait='):
+            return None
+        try:
+            wait = float(prefer[len('wait='):])
+        except ValueError:
+            return None
+        end = time.time() + wait
+        self.mutex.acquire()
+        try:
+            while self.isCurrent(headers) and time.time() < end:
+                self.changed.wait(end - time.time())
+        finally:
+            self.mutex.release()
+        return prefer
+
+    def count(self, route):
+        '''Count one request for route.'''
+        self.mutex.acquire()
+        try:
+            self.counts[route] += 1
+        finally:
+            self.mutex.release()
+
+    def fails(self):
+        '''Return True if this request should fail, failure_rate of the time.'''
+        self.mutex.acquire()
+        try:
+            return self.random.random() < self.failureRate
+        finally:
+            self.mutex.release()
+
+    def isCurrent(self, headers):
+        '''Return True if the validators in the request headers show the
+        client has the config as served since start-up.'''
+        if headers.get('If-None-Match'):
+            return headers.get('If-None-Match') == self.etag
+        since = headers.get('If-Modified-Since')
+        if since:
+            parsed = email.utils.parsedate_tz(since)
+            return parsed != None and email.utils.mktime_tz(parsed) >= self.modified
+        return False
+
+    def originRequests(self):
+        '''Return the requests answered on every route.'''
+        return sum(self.counts.values())
+
+    def record(self, body_bytes):
+        '''Count one answered request that sent body_bytes.'''
+        self.mutex.acquire()
+        try:
+            self.requests  += 1
+            self.bytesSent += body_bytes
+        finally:
+            self.mutex.release()
+
+    def reset(self):
+        '''Zero the request, route and byte counters.'''
+        self.mutex.acquire()
+        try:
+            self.requests  = 0
+            self.bytesSent = 0
+            for route in self.counts.keys():
+                self.counts[route] = 0
+        finally:
+            self.mutex.release()
+
+    def url(self, path='/config'):
+        '''Return the URL for path on this server.'''
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_address[1], path)
+
+    def start(self):
+        '''Start answering requests in a background thread.'''
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        '''Stop answering requests.'''
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def generateConfig(size):
+    '''Return an HTCondor config of about size bytes, as repetitive as the
+    generated configs the benchmarks model.'''
+    lines = []
+    total = 0
+    index = 0
+    while total < size:
+        line = 'SLOT%d_ATTRIBUTE_%d = $(SLOT_TYPE_%d) && (TARGET.RequestMemory <= %d)\n' % \
+                (index % 64, index, index % 8, 1024 * (index % 16 + 1))
+        lines.append(line)
+        total += len(line)
+        index += 1
+    return ''.join(lines)
+
+
+if __name__ == "__main__":
+    port         = 8080
+    size         = 1024 * 1024
+    latency      = 0.0
+    failure_rate = 0.0
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        size = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        latency = float(sys.argv[3])
+    if len(sys.argv) > 4:
+        failure_rate = float(sys.argv[4])
+    server = ConfigServer(generateConfig(size), port=port, latency=latency,
+                          failure_rate=failure_rate)
+    print "Serving a %d byte config at %s" % (size, server.url())
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
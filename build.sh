@@ -19,7 +19,7 @@
 ################################################################################
 
 
-VERSION=`sed -n -e 's/__version__ = "\(.*\)"/\1/p' cache_config.py | tr -d '\r'`
+VERSION=`sed -n -e 's/__version__ = "\(.*\)"/\1/p' cache_config_common.py | tr -d '\r'`
 
 echo "Building version $VERSION of cache_config..."
 
@@ -57,7 +57,7 @@ prep_build() {
 ## Native python build
 prep_build
 
-cp cache_config.py $BUILD_DIR
+cp cache_config.py cache_config_common.py cache_config_lib.py $BUILD_DIR
 
 FILE=cache_config-$VERSION-python.tar.gz
 
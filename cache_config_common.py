@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+# What both a cache hit in cache_config.py and the rest of cache_config in
+# cache_config_lib.py need: the options, how long a cache lives, printing it
+# and asking a daemon for it. Kept small, as a cache hit loads it. See
+# cache_config.py and README.md for usage.
+
+################################################################################
+# IMPORTS
+################################################################################
+# Anything else is imported by the code that uses it.
+import os
+
+
+################################################################################
+# GLOBALS
+################################################################################
+
+__version__ = "1.2"
+
+# OPTION CONFIGURATION
+# Every recognised --name[=value] option and its value when it is not given.
+option_defaults = dict()
+option_defaults['stale-while-revalidate'] = False
+option_defaults['max-stale']              = None
+option_defaults['refresh-only']           = False # internal: background refresh
+option_defaults['daemon']                 = False
+option_defaults['use-daemon']             = False
+option_defaults['socket']                 = None
+option_defaults['race']                   = None
+option_defaults['fsync']                  = False
+option_defaults['compress-cache']         = False
+option_defaults['batch']                  = None
+option_defaults['batch-workers']          = 4
+option_defaults['tier']                   = None
+option_defaults['serve-tier']             = None
+option_defaults['tier-port']              = 8642
+option_defaults['tier-bind']              = ''
+option_defaults['tier-origins']           = None
+option_defaults['tier-min-ttl']           = 30
+option_defaults['ttl-jitter']             = 0.0
+option_defaults['early-refresh']          = None
+option_defaults['circuit-breaker']        = False
+option_defaults['connect-timeout']        = 15
+option_defaults['read-timeout']           = 15
+option_defaults['deadline']               = None
+option_defaults['digest']                 = False
+option_defaults['query']                  = None
+option_defaults['metrics']                = None
+option_defaults['metrics-summary']        = None
+option_defaults['watch']                  = None
+option_defaults['layers']                 = None
+option_defaults['dns-cache']              = None
+option_defaults['dns-ttl']                = 300
+
+# The options that only change how an expired cache is refreshed, so a cache
+# hit given no others is served by cache_config.py alone. cache_config_lib
+# checks the values of those a hit does not use when a refresh needs them.
+hit_options = ['stale-while-revalidate', 'max-stale', 'race', 'fsync', 'compress-cache',
+               'tier', 'circuit-breaker', 'connect-timeout', 'read-timeout', 'deadline',
+               'dns-cache', 'dns-ttl', 'use-daemon', 'socket', 'ttl-jitter',
+               'early-refresh']
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def splitOptions(argv):
+    '''Split a command line into a dictionary of the options given and a
+    list of the remaining positional arguments. Options take the form --name
+    or --name=value; an option given without a value is set to True. Raises
+    ValueError for an unrecognised option.'''
+    options   = dict()
+    arguments = []
+    for arg in argv:
+        if arg[:2] == '--' and len(arg) > 2:
+            name, separator, value = arg[2:].partition('=')
+            if not option_defaults.has_key(name):
+                raise ValueError("Unknown option: --%s" % name)
+            if separator:
+                options[name] = value
+            else:
+                options[name] = True
+        else:
+            arguments.append(arg)
+    return options, arguments
+
+
+def parseOptions(argv):
+    '''Split a command line as splitOptions() does, except that an option
+    that is not given keeps its value from option_defaults.'''
+    given, arguments = splitOptions(argv)
+    options = dict(option_defaults)
+    options.update(given)
+    return options, arguments
+
+
+def ttlJitter(options=option_defaults):
+    '''Return the fraction the ttl-jitter option shortens the TTL by. Raises
+    ValueError if it is not valid.'''
+    ttl_jitter = float(options['ttl-jitter'])
+    if ttl_jitter < 0.0 or ttl_jitter >= 1.0:
+        raise ValueError("--ttl-jitter must be at least 0 and less than 1")
+    return ttl_jitter
+
+
+def earlyRefreshWindow(ttl, options=option_defaults):
+    '''Return the window in seconds before a TTL of ttl runs out in which the
+    early-refresh option lets a cache be refreshed early, or None for
+    never.'''
+    early_refresh = options['early-refresh']
+    if early_refresh == True:
+        return ttl / 10.0
+    if early_refresh != None:
+        return float(early_refresh)
+    return None
+
+
+def jitteredTtl(file_name, ttl, ttl_jitter):
+    '''Return ttl shortened by up to the fraction ttl_jitter, by an amount
+    that is the same on every run for this host and cache file, so that
+    hosts whose caches were written together do not all expire together.'''
+    if not ttl_jitter:
+        return float(ttl)
+    import zlib
+    if hasattr(os, 'uname'):
+        host = os.uname()[1]
+    else:
+        host = os.environ.get('COMPUTERNAME', '')
+    key      = '%s:%s' % (host, os.path.abspath(file_name))
+    fraction = (zlib.crc32(key) & 0xffffffff) / float(0x100000000)
+    return float(ttl) * (1.0 - float(ttl_jitter) * fraction)
+
+
+def earlyRefreshChance(ttl, cache_age, early_refresh):
+    '''Return the chance that a cache cache_age seconds old, with the given
+    TTL, is refreshed early within a window of early_refresh seconds. It
+    rises towards certainty as the TTL runs out.'''
+    import math
+    return math.exp(-(ttl - cache_age) / float(early_refresh))
+
+
+def readDaemon(socket_name, cache_file_name, timeout):
+    '''Ask a ConfigDaemon listening on socket_name for the config text of
+    cache_file_name, waiting up to timeout seconds. Returns the text, or
+    None if there is none or this platform has no Unix-domain sockets.
+    Raises socket.error if no daemon answered.'''
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(socket_name)
+        client.sendall(os.path.abspath(cache_file_name) + '\n')
+        reply = []
+        data  = client.recv(65536)
+        while data:
+            reply.append(data)
+            data = client.recv(65536)
+    finally:
+        client.close()
+    if not reply:
+        return None
+    return ''.join(reply)
+
+
+def sendCache(file_name, out_fp):
+    '''Write the cache file file_name to out_fp's file descriptor straight
+    from a memory map, with no copies made in Python. Returns False, having
+    written nothing, if it must go through openCache() instead: it is
+    compressed, needs carriage returns translated or out_fp has no
+    descriptor.'''
+    import mmap
+    if os.name == 'nt' or not hasattr(out_fp, 'fileno'):
+        return False
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return True
+        view = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+    finally:
+        os.close(fd)
+    try:
+        if view[:2] == '\x1f\x8b' or view.find('\r') != -1:
+            return False
+        out_fp.flush()
+        out_fd  = out_fp.fileno()
+        written = 0
+        while written < size:
+            written += os.write(out_fd, buffer(view, written))
+        return True
+    finally:
+        view.close()
+
+
+def sendCompressed(file_name, out_fp):
+    '''Write the gzip-compressed cache file file_name to out_fp,
+    decompressed. Returns False, having written nothing, if it is not a
+    single gzip member whose length and CRC check out.'''
+    import struct
+    import zlib
+    fp = open(file_name, 'rb')
+    try:
+        data = fp.read()
+    finally:
+        fp.close()
+    if data[:2] != '\x1f\x8b' or len(data) < 18:
+        return False
+    # Held in memory until it is known to be whole, so a damaged cache is
+    # never half printed before cache_config_lib prints it again.
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        config = decompressor.decompress(data) + decompressor.flush()
+    except zlib.error:
+        return False
+    crc, size = struct.unpack('<II', data[-8:])
+    if decompressor.unused_data or crc != zlib.crc32(config) & 0xffffffff or \
+            size != len(config) & 0xffffffff:
+        return False
+    out_fp.write(config)
+    return True
@@ -0,0 +1,3223 @@
+#!/usr/bin/env python
+
+###### COPYRIGHT NOTICE ########################################################
+#
+# Copyright (C) 2007-2011, Cycle Computing, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you
+# may not use this file except in compliance with the License.  You may
+# obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+################################################################################
+
+################################################################################
+# USAGE
+################################################################################
+
+# Everything cache_config does besides printing an unexpired cache: refreshing
+# it, and the daemon, tier, batch and metrics modes. cache_config.py imports
+# this module only when a run needs it. See cache_config.py and README.md for
+# usage.
+
+################################################################################
+# IMPORTS
+################################################################################
+# What only some modes use (urllib2 and the rest of the network stack,
+# locking, temp files, JSON, compression) is imported by the code that uses
+# it.
+import sys
+import os.path
+import time
+import logging
+
+from cache_config_common import __version__, option_defaults, parseOptions, ttlJitter, \
+     earlyRefreshWindow, jitteredTtl, earlyRefreshChance, readDaemon, sendCache
+
+
+################################################################################
+# GLOBALS
+################################################################################
+
+# SOCKET CONFIGURATION
+__timeout__ = 2 # seconds
+
+# HEALTH CONFIGURATION
+__backoff_base__ = 10  # seconds a URL is skipped after its first failure
+__max_backoff__  = 600 # seconds a URL is skipped at most, by default
+
+# RESOLVER CONFIGURATION
+__resolver__ = None # the AddressCache for this run, when --dns-cache is given
+
+# WATCH CONFIGURATION
+__watch_wait__ = 60 # seconds a server is asked to hold a --watch request open
+
+# STREAMING CONFIGURATION
+__chunk_size__ = 64*1024 # bytes
+
+# METRICS CONFIGURATION
+__metrics__ = None # the RunMetrics for this run, when --metrics is given
+
+
+# LOGGING CONFIGURATION
+log_level_map      = dict()
+log_level_map['1'] = logging.DEBUG
+log_level_map['2'] = logging.INFO
+log_level_map['3'] = logging.WARNING
+log_level_map['4'] = logging.ERROR
+log_level_map['5'] = logging.CRITICAL
+
+env_var    = '_CACHE_TOOL_DEBUG'
+should_log = os.environ.has_key(env_var) and log_level_map.has_key(os.environ[env_var])
+
+if should_log:
+    logLevel = log_level_map[os.environ[env_var]]
+else:
+    logLevel = logging.CRITICAL
+
+# Logging is set up by setupLogging(), first thing in main().
+
+# OPTION CONFIGURATION
+# The options and their defaults, option_defaults, are in cache_config_common.
+
+
+################################################################################
+# CLASSES
+################################################################################
+
+class DirectoryLockError(IOError):
+    '''Error class for DirectorLock.'''
+    # TBD Fill this in
+    pass
+
+
+class DirectoryLock:
+    '''Platform-independent, directory-based, forceable locking mechanism.
+    Where the OS has fcntl.flock() it is an exclusive flock() on a lock file,
+    which the kernel hands on at once and frees if the holder dies;
+    elsewhere it is the directory itself, polled every timeStep seconds.'''
+
+    def __init__(self, directory_name, step_base=1, step_random_coeff=0.2):
+        '''Create a directory-based lock and use the timeout to re-attempt the
+        lock acquisition'''
+        import random
+        self.isLocked       = False
+        self.dirName        = directory_name
+        self.lockFileName   = directory_name + '.lock'
+        self.lockFd         = None
+        self.fcntl          = flockModule()
+        self.isStepRandom   = step_random_coeff == 0.0
+        self.timeStep       = step_base*(1+(step_random_coeff*(1.0-2*random.random())))
+        logging.info('Created a directory lock with timeStep %s seconds.' % str(self.timeStep))
+
+
+    def acquire(self, acquire_by_force=True, lock_timeout=30):
+        '''Attempt to acquire the lock, with a configuration timeout value. Return True if
+        acquired. False if acquie was forced. Raises DirectoryLockError if directory is
+        already locked. Only an flock() lock is forced: a lock directory that is not stale
+        is left to its holder, as releasing it would remove it from under them.'''
+        if lock_timeout <= 0:
+            logmsg = "Error Acquiring DirectoryLock: '%s' with invalid timeout of '%d' seconds" % \
+                    (self.dirName, lock_timeout)
+            logging.error(logmsg)
+            raise DirectoryLockError(logmsg)
+
+        if self.isLocked == True:
+            logmsg = "Error Acquiring DirectoryLock: '%s' is already locked!" % self.dirName
+            logging.error(logmsg)
+            raise DirectoryLockError(logmsg)
+
+        logging.info("Acquiring lock")
+        if self.fcntl != None and self.acquireFlock(lock_timeout):
+            logging.info("Successfully acquired the lock.")
+            self.isLocked = True
+            return True
+        if self.lockFd == None:
+            if self.acquireDirectory(lock_timeout):
+                logging.info("Successfully acquired the lock.")
+                self.isLocked = True
+                return True
+            logmsg = "Error acquiring DirectoryLock on '%s': still held" % self.dirName
+            logging.error(logmsg)
+            raise DirectoryLockError(logmsg)
+
+        if acquire_by_force:
+            logging.warning("Acquiring lock by force")
+            self.isLocked = True
+            return False
+        else:
+            logmsg = "Error acquiring DirectoryLock on '%s'" % self.dirName
+            logging.error(logmsg)
+            raise DirectoryLockError(logmsg)
+
+
+    def openLockFile(self, flags=0):
+        '''Open the lock file for writing if we may, as flock() emulated
+        with fcntl() locks on NFS needs, and for reading otherwise. Returns
+        the descriptor. Raises os.error if it cannot be opened.'''
+        try:
+            return os.open(self.lockFileName, os.O_RDWR | flags, 0666)
+        except os.error:
+            return os.open(self.lockFileName, os.O_RDONLY | flags, 0666)
+
+
+    def acquireFlock(self, lock_timeout):
+        '''Wait up to lock_timeout seconds for an exclusive flock() on the
+        lock file. Return True if it was acquired. If the lock file cannot be
+        opened or locked at all, lockFd is left as None so the caller can use
+        the lock directory instead.'''
+        import errno
+        try:
+            fd = self.openLockFile(os.O_CREAT)
+        except os.error, err:
+            logging.warning("Cannot open lock file %s: %s" % (self.lockFileName, err))
+            return False
+
+        try:
+            self.fcntl.flock(fd, self.fcntl.LOCK_EX | self.fcntl.LOCK_NB)
+            self.lockFd = fd
+            return True
+        except IOError, err:
+            if err.errno not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                # Not held by anyone: flock() does not work here.
+                logging.warning("Cannot lock lock file %s: %s" % (self.lockFileName, err))
+                os.close(fd)
+                return False
+            logging.info("Lock file is locked, waiting.")
+        self.lockFd = fd
+
+        # flock() itself has no timeout, so block on it in a helper thread
+        # and give up on that thread if it is not done within lock_timeout.
+        import threading
+        fcntl    = self.fcntl
+        state    = { 'acquired' : False, 'failed' : False, 'abandoned' : False }
+        mutex    = threading.Lock()
+        finished = threading.Event()
+
+        def wait():
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                outcome = 'acquired'
+            except IOError, err:
+                logging.warning("Error waiting for lock file: %s" % err)
+                outcome = 'failed'
+            mutex.acquire()
+            try:
+                if state['abandoned']:
+                    # Too late: the caller has moved on without the lock.
+                    os.close(fd)
+                else:
+                    state[outcome] = True
+                    finished.set()
+            finally:
+                mutex.release()
+
+        waiter = threading.Thread(target=wait)
+        waiter.setDaemon(True)
+        waiter.start()
+        finished.wait(lock_timeout)
+
+        mutex.acquire()
+        try:
+            if state['failed']:
+                os.close(fd)
+                self.lockFd = None
+            elif not state['acquired']:
+                state['abandoned'] = True
+                # The waiter owns the descriptor now and closes it.
+                self.lockFd = -1
+            return state['acquired']
+        finally:
+            mutex.release()
+
+
+    def acquireDirectory(self, lock_timeout):
+        '''Poll for up to lock_timeout seconds to create the lock directory.
+        Return True if it was created. A lock directory that has existed for
+        longer than lock_timeout was left behind by a holder that died or
+        hung, so it is taken over; any other is left alone.'''
+        wait_duration = 0
+        while wait_duration < lock_timeout:
+            wait_duration += self.timeStep
+            try:
+                if os.path.isdir(self.dirName):
+                    logging.info("Lock directory exists")
+                    raise os.error
+                else:
+                    logging.info("Creating lock directory")
+                    os.mkdir(self.dirName)
+            except os.error, err:
+                logging.info("Lock directory exists sleeping.")
+                time.sleep(self.timeStep)
+            else:
+                return True
+
+        # The stale directory is renamed out of the way before it is
+        # removed, so that of several waiters only one takes it over, and
+        # its age checked again, in case that was a new holder's.
+        staleName = '%s.%d.stale' % (self.dirName, os.getpid())
+        try:
+            lockAge = time.time() - os.path.getmtime(self.dirName)
+            if lockAge <= lock_timeout:
+                logging.info("Lock directory is held, %s seconds old" % lockAge)
+                return False
+            os.rename(self.dirName, staleName)
+            lockAge = time.time() - os.path.getmtime(staleName)
+            if lockAge <= lock_timeout:
+                os.rename(staleName, self.dirName)
+                logging.info("Lock directory was taken over by another waiter")
+                return False
+            os.rmdir(staleName)
+            logging.warning("Taking over stale lock directory, %s seconds old" % lockAge)
+            os.mkdir(self.dirName)
+            return True
+        except os.error, err:
+            logging.warning("Error taking over stale lock directory: %s" % err)
+        return False
+
+
+    def isBusy(self):
+        '''Return True if another process holds the lock right now, without
+        waiting for it.'''
+        import errno
+        fcntl = self.fcntl
+        if fcntl != None and os.path.exists(self.lockFileName):
+            try:
+                fd = self.openLockFile()
+            except os.error:
+                return os.path.isdir(self.dirName)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError, err:
+                    if err.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        return True
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        return os.path.isdir(self.dirName)
+
+
+    def __del__(self):
+        '''Automatically destroy the lock when the object is deleted.'''
+        if self.isLocked:
+            self.release(True)
+
+         
+    def release(self, raise_remove_error=False):
+        '''Release the lock. Raises DirectoryLockError if lock cannot be removed
+        or does not exist.'''
+        if not self.isLocked:
+            logmsg = "Error releasing DirectoryLock: '%s' is not locked yet!" % self.dirName
+            logging.error(logmsg)
+            raise DirectoryLockError(logmsg)
+        self.isLocked = False
+        if self.lockFd != None:
+            # The lock file stays in place for the next holder; a forced
+            # lock has nothing of its own to release.
+            if self.lockFd >= 0:
+                self.fcntl.flock(self.lockFd, self.fcntl.LOCK_UN)
+                os.close(self.lockFd)
+            self.lockFd = None
+            return
+        try:
+            os.rmdir(self.dirName)
+        except os.error, err:
+            if raise_remove_error:
+                logmsg = "Error releasing DirectoryLock: '%s' remove appeared to fail!" % self.dirName
+                logging.error(logmsg)
+                raise DirectoryLockError(logmsg)
+
+
+class CacheConfigFile:
+    '''An object representation of a config cache file. Provides some utility
+    functions for dealing with cached configs on disk.'''
+
+    def __init__(self, filename, ttl=30, ttl_jitter=0.0, early_refresh=None):
+        '''ttl_jitter is the fraction by which the TTL may be shortened, by an
+        amount fixed for this host and cache file. early_refresh is the window
+        in seconds before the TTL runs out in which the cache may be
+        refreshed early, or None for never.'''
+        self.fileName      = filename
+        self.fileTTL       = ttl
+        self.ttlJitter     = ttl_jitter
+        self.earlyRefresh  = early_refresh
+        self.earlyDraw     = None
+        self.tempFileNames = dict()
+        self.fileMode      = None
+
+    def __del__(self):
+        '''Clean up any temporary files that were created.'''
+        self.removeTemporaryFiles()
+
+    def removeTemporaryFiles(self):
+        '''Remove any temporary files that were created and not installed.'''
+        for tempFileName in self.tempFileNames.values():
+            removeFile(tempFileName)
+
+    def temporaryFileName(self, suffix=''):
+        '''Return the name of a unique, temporary file we can use. It is
+        created securely in the cache file\'s directory, so it can be renamed
+        over the cache file. A suffix gives another unique name, for when
+        several temporary files are needed at once. Once the file has been
+        installed or removed, a new one is made.'''
+        import tempfile
+        if self.fileMode == None:
+            # Temp files are renamed in to place, so give them the permissions
+            # the cache file has, or would get if it were created with open().
+            if self.exists():
+                import stat
+                self.fileMode = stat.S_IMODE(os.stat(self.fileName).st_mode)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                self.fileMode = 0666 & ~umask
+        tempFileName = self.tempFileNames.get(suffix)
+        if tempFileName == None or not os.path.exists(tempFileName):
+            directory, base = os.path.split(os.path.abspath(self.fileName))
+            fd, tempFileName = tempfile.mkstemp(suffix, base + '.', directory)
+            os.close(fd)
+            os.chmod(tempFileName, self.fileMode)
+            self.tempFileNames[suffix] = tempFileName
+            logging.info("CacheConfigFile created tempFileName: %s" % tempFileName)
+        return tempFileName
+
+    def exists(self):
+        '''Returns True if the cache file exists on disk, otherwise False.'''
+        return os.path.exists(self.fileName)
+
+    def lastModified(self):
+        '''Return the time the cache file was last modified, or None if the
+        cache file does not exist.'''
+        try:
+            return os.path.getmtime(self.fileName)
+        except os.error:
+            return None
+
+    def age(self):
+        '''Return the age of the cache file in seconds, or None if the cache
+        file does not exist.'''
+        lastModified = self.lastModified()
+        if lastModified == None:
+            return None
+        logging.info("CacheConfigFile last modified: %s" % lastModified)
+        cacheAge = time.time()-lastModified
+        logging.info("CacheConfigFile age: %s" % cacheAge)
+        return cacheAge
+
+    def ttl(self):
+        '''Return the TTL for this file in seconds. With a ttlJitter, it is
+        shortened by up to that fraction, by an amount that is the same on
+        every run for this host and cache file, so that hosts whose caches
+        were written together do not all expire together.'''
+        return jitteredTtl(self.fileName, self.fileTTL, self.ttlJitter)
+
+    def hasExpired(self, cacheAge):
+        '''Return True if a cache file cacheAge seconds old should be
+        refreshed: its TTL has run out or, within the earlyRefresh window, it
+        was picked for an early refresh, with a chance that rises towards
+        certainty. The pick is fixed until the file changes.'''
+        ttl = self.ttl()
+        if cacheAge >= ttl:
+            return True
+        if self.earlyRefresh:
+            import random
+            if self.earlyDraw == None:
+                self.earlyDraw = random.random()
+            if self.earlyDraw < earlyRefreshChance(ttl, cacheAge, self.earlyRefresh):
+                logging.info("CacheConfigFile picked for early refresh")
+                return True
+        return False
+
+    def shouldUpdate(self):
+        '''Check the cache file\'s timestamp against the TTL value for this file
+        set when the object was created. Return True if the TTL has expired.
+        Otherwise False. See hasExpired().'''
+        cacheAge = self.age()
+        if cacheAge != None and not self.hasExpired(cacheAge):
+            logging.info("CacheConfigFile can be reused!")
+            return False
+        logging.info("CacheConfigFile should be updated!")
+        return True
+
+    def canServeStale(self, max_stale):
+        '''Return True if the cache file exists and is no more than max_stale
+        seconds past its TTL, so it may be served while a refresh happens in
+        the background. Otherwise False.'''
+        cacheAge = self.age()
+        if cacheAge == None:
+            return False
+        return cacheAge < self.ttl() + float(max_stale)
+
+
+class NotModified(Exception):
+    '''Raised when a server reports that the cached config is still current.'''
+    pass
+
+
+class DeltaError(Exception):
+    '''Raised when a delta from a server cannot be applied to the cached
+    config.'''
+    pass
+
+
+class DecodingReader:
+    '''A read-only file-like wrapper that undoes the Content-Encoding of an
+    HTTP response as it is read, a chunk at a time.'''
+
+    def __init__(self, fp, encoding):
+        import zlib
+        self.fp       = fp
+        self.encoding = encoding
+        self.pending  = ''
+        if encoding in ('gzip', 'x-gzip'):
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            # Servers disagree on whether deflate has a zlib header, so the
+            # first chunk decides. See read().
+            self.decoder = None
+        elif encoding == 'zstd' and zstdModule() != None:
+            self.decoder = zstdModule().ZstdDecompressor().decompressobj()
+        else:
+            raise IOError("Unsupported Content-Encoding: %s" % encoding)
+
+    def read(self, size=__chunk_size__):
+        '''Return the next decoded chunk of the response, which may be longer
+        than size, or '' at the end of the response.'''
+        import zlib
+        while True:
+            data = self.fp.read(size)
+            if data == '':
+                if self.decoder == None:
+                    return ''
+                if not self.finished():
+                    # Cut off: a partial config must not replace the cache.
+                    raise IOError("%s response ended before the end of its "
+                                  "compressed data" % self.encoding)
+                rest, self.decoder = self.decoder.flush(), None
+                return rest
+            if self.decoder == None:
+                self.decoder = zlib.decompressobj()
+                try:
+                    decoded = self.decoder.decompress(data)
+                except zlib.error:
+                    # Raw deflate data with no zlib header
+                    self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                    decoded = self.decoder.decompress(data)
+            else:
+                decoded = self.decoder.decompress(data)
+            if decoded != '':
+                return decoded
+
+    def finished(self):
+        '''Return True if the decoder has seen the whole compressed stream,
+        trailer and all. zlib in this Python has no eof flag, so a copy of
+        the decoder is given one more byte, which is left over in
+        unused_data once the stream has ended.'''
+        import zlib
+        if hasattr(self.decoder, 'eof'):
+            return self.decoder.eof
+        if not hasattr(self.decoder, 'copy'):
+            return True
+        if self.decoder.unused_data:
+            return True
+        probe = self.decoder.copy()
+        try:
+            probe.decompress('\0')
+        except zlib.error:
+            return False
+        return probe.unused_data != ''
+
+    def close(self):
+        '''Close the underlying response.'''
+        self.fp.close()
+
+
+class DeadlineExceeded(IOError):
+    '''Raised when the deadline for a refresh has passed.'''
+    pass
+
+
+class Timeouts:
+    '''How long to wait on a server while fetching configs: to connect, and
+    for each read once connected. An optional deadline, budget seconds from
+    when the object is made, bounds the whole refresh.'''
+
+    def __init__(self, connect=15, read=15, budget=None):
+        self.connect  = float(connect)
+        self.read     = float(read)
+        self.budget   = budget
+        self.deadline = None
+        if budget != None:
+            self.deadline = time.time() + float(budget)
+
+    def remaining(self):
+        '''Return the seconds left before the deadline, or None if there is
+        no deadline.'''
+        if self.deadline == None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def expired(self):
+        '''Return True if the deadline has passed.'''
+        return self.deadline != None and time.time() >= self.deadline
+
+    def limit(self, seconds):
+        '''Return seconds, cut short to the time left before the deadline.'''
+        remaining = self.remaining()
+        if remaining == None or seconds < remaining:
+            return seconds
+        # Never zero, which would make a socket non-blocking.
+        return max(0.01, remaining)
+
+    def check(self):
+        '''Raise DeadlineExceeded if the deadline has passed.'''
+        if self.expired():
+            raise DeadlineExceeded("deadline of %g seconds passed" % float(self.budget))
+
+
+class DeadlineReader:
+    '''A read-only file-like wrapper that raises DeadlineExceeded once the
+    deadline of its Timeouts has passed, however steadily data arrives.'''
+
+    def __init__(self, fp, timeouts):
+        self.fp       = fp
+        self.timeouts = timeouts
+
+    def read(self, size=__chunk_size__):
+        '''Return the next chunk of up to size bytes.'''
+        self.timeouts.check()
+        return self.fp.read(size)
+
+    def close(self):
+        '''Close the underlying response.'''
+        self.fp.close()
+
+
+class DeadlineSocket:
+    '''A socket wrapper that cuts the timeout of every recv() short to the
+    time left before the deadline of its Timeouts, so a server that sends a
+    byte at a time cannot hold a read open past it.'''
+
+    def __init__(self, sock, timeouts):
+        self.sock     = sock
+        self.timeouts = timeouts
+        self._makefile_refs = 0
+
+    def recv(self, *args):
+        '''Receive as the socket does. Raises DeadlineExceeded if the
+        deadline passes first.'''
+        import socket
+        self.timeouts.check()
+        timeout = self.timeouts.limit(self.timeouts.read)
+        self.sock.settimeout(timeout)
+        try:
+            return self.sock.recv(*args)
+        except socket.timeout:
+            # The wait may end a moment before the deadline; if it was cut
+            # short to the deadline, the deadline is what ran out.
+            if timeout < self.timeouts.read:
+                raise DeadlineExceeded("deadline of %g seconds passed"
+                                       % float(self.timeouts.budget))
+            raise
+
+    def makefile(self, mode='r', bufsize=-1):
+        '''Return a file object that reads through recv() above. As with
+        an SSLSocket, the socket stays open until that file is closed too.'''
+        import socket
+        self._makefile_refs += 1
+        return socket._fileobject(self, mode, bufsize, close=True)
+
+    def close(self):
+        '''Close the socket, once no file from makefile() still needs it.
+        httplib closes a Connection: close connection before its response
+        body has been read.'''
+        if self._makefile_refs < 1:
+            self.sock.close()
+        else:
+            self._makefile_refs -= 1
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class DigestReader:
+    '''Wrap a file-like object, keeping a SHA-1 digest of everything read
+    from it.'''
+
+    def __init__(self, fp):
+        import hashlib
+        self.fp   = fp
+        self.hash = hashlib.sha1()
+
+    def read(self, size=__chunk_size__):
+        chunk = self.fp.read(size)
+        self.hash.update(chunk)
+        return chunk
+
+    def hexdigest(self):
+        '''Return the digest of what has been read so far, in hex.'''
+        return self.hash.hexdigest()
+
+    def close(self):
+        self.fp.close()
+
+
+class MeteredReader:
+    '''Wrap a file-like object, counting the bytes read from it in a
+    RunMetrics.'''
+
+    def __init__(self, fp, metrics):
+        self.fp      = fp
+        self.metrics = metrics
+
+    def read(self, size=__chunk_size__):
+        chunk = self.fp.read(size)
+        self.metrics.add('bytes', len(chunk))
+        return chunk
+
+    def close(self):
+        self.fp.close()
+
+
+class HeldWriter:
+    '''A write-only file-like wrapper that holds back what is written to fp,
+    in memory, for as long as it could still be a copy of size bytes. Once
+    more is written it is a different copy, so everything is passed on.'''
+
+    def __init__(self, fp, size):
+        self.fp      = fp
+        self.size    = size
+        self.held    = []
+        self.written = 0
+
+    def write(self, data):
+        if self.held != None:
+            self.written += len(data)
+            if self.written <= self.size:
+                self.held.append(data)
+                return
+            self.release()
+        self.fp.write(data)
+
+    def release(self):
+        '''Pass on everything held back, as this is not the copy after all.'''
+        if self.held:
+            self.fp.write(''.join(self.held))
+        self.held = None
+
+    def discard(self):
+        '''Drop everything held back, as this is the copy.'''
+        self.held = None
+
+
+class PooledResponse:
+    '''The socket-like end of an HTTP response read over a ConnectionPool
+    connection. Closing it hands the connection back to the pool if the
+    response was read to the end and the server will keep it open.'''
+
+    def __init__(self, pool, key, connection, response):
+        self.pool       = pool
+        self.key        = key
+        self.connection = connection
+        self.response   = response
+
+    def recv(self, size):
+        '''Return up to size bytes of the response body.'''
+        return self.response.read(size)
+
+    def close(self):
+        '''Finish with the response and release its connection.'''
+        if self.connection == None:
+            return
+        import httplib
+        import socket
+        connection, self.connection = self.connection, None
+        finished = self.response.isclosed() or self.response.length == 0
+        if not finished and self.response.length != None and \
+                self.response.length <= __chunk_size__:
+            # A short body left unread, such as an error page, is cheaper
+            # to read than a new connection.
+            try:
+                self.response.read()
+                finished = True
+            except (socket.error, httplib.HTTPException):
+                pass
+        self.response.close()
+        if finished and not self.response.will_close:
+            self.pool.put(self.key, connection)
+        else:
+            connection.close()
+
+
+class ConnectionPool:
+    '''Idle keep-alive HTTP and HTTPS connections, kept per server, so that
+    fetches from the same server share one connection rather than each
+    opening its own. Safe to use from several threads. See buildOpener().'''
+
+    def __init__(self):
+        import threading
+        self.idle   = dict()
+        self.opened = 0
+        self.mutex  = threading.Lock()
+
+    def get(self, key, connection_class, host, timeout):
+        '''Return an idle connection for key, or a new connection_class to
+        host if there is none, and whether it is a reused connection.'''
+        self.mutex.acquire()
+        try:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop(), True
+            self.opened += 1
+        finally:
+            self.mutex.release()
+        logging.info("Opening connection to %s" % host)
+        return connection_class(host, timeout=timeout), False
+
+    def put(self, key, connection):
+        '''Keep connection for the next request with the same key.'''
+        self.mutex.acquire()
+        try:
+            self.idle.setdefault(key, []).append(connection)
+        finally:
+            self.mutex.release()
+
+    def close(self):
+        '''Close every idle connection.'''
+        self.mutex.acquire()
+        try:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = dict()
+        finally:
+            self.mutex.release()
+
+    def open(self, connection_class, req):
+        '''Send the urllib2 Request req on a pooled connection_class
+        connection, one of those made by buildOpener(), and return the
+        response, just as urllib2 would. A reused connection that the server
+        has closed meanwhile is replaced by a new one.'''
+        import httplib
+        import socket
+        import urllib
+        import urllib2
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        for name, value in req.headers.items():
+            if not headers.has_key(name):
+                headers[name] = value
+        headers = dict([(name.title(), value) for name, value in headers.items()])
+
+        # An https request through a proxy tunnels to the real server, and
+        # only the proxy may see its credentials.
+        tunnel_host    = getattr(req, '_tunnel_host', None)
+        tunnel_headers = dict()
+        if tunnel_host and headers.has_key('Proxy-Authorization'):
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        key = (connection_class, host, tunnel_host)
+        while True:
+            connection, reused = self.get(key, connection_class, host, req.timeout)
+            if reused and connection.sock != None:
+                connection.sock.settimeout(connection.readTimeout())
+            elif tunnel_host:
+                connection.set_tunnel(tunnel_host, headers=tunnel_headers)
+            try:
+                connection.request(req.get_method(), req.get_selector(), req.data, headers)
+                response = connection.getresponse(buffering=True)
+                break
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if reused:
+                    logging.info("Pooled connection to %s was closed: %s" % (host, e))
+                    continue
+                if isinstance(e, socket.error):
+                    raise urllib2.URLError(e)
+                raise
+
+        fp = socket._fileobject(PooledResponse(self, key, connection, response), close=True)
+        result = urllib.addinfourl(fp, response.msg, req.get_full_url())
+        result.code = response.status
+        result.msg  = response.reason
+        return result
+
+
+class JsonFile:
+    '''A dictionary of values kept as JSON in the file file_name. A file that
+    is missing or cannot be read starts out empty.'''
+
+    def __init__(self, file_name):
+        import json
+        self.fileName = file_name
+        self.values   = dict()
+        try:
+            fp = open(self.fileName, 'r')
+            try:
+                self.values = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError), e:
+            logging.info("No usable values in %s: %s" % (self.fileName, e))
+
+    def get(self, key, default=None):
+        '''Return the stored value for key, or default if there is none.'''
+        return self.values.get(key, default)
+
+    def update(self, values):
+        '''Store the keys and values in the dictionary values.'''
+        self.values.update(values)
+
+    def remove(self):
+        '''Forget every stored value and remove the file.'''
+        self.values = dict()
+        removeFile(self.fileName)
+
+    def save(self):
+        '''Write the stored values to the file, replacing it in one atomic
+        rename.'''
+        import json
+        import tempfile
+        directory, base = os.path.split(os.path.abspath(self.fileName))
+        fd, tempFileName = tempfile.mkstemp('', base + '.', directory)
+        try:
+            fp = os.fdopen(fd, 'w')
+            try:
+                json.dump(self.values, fp)
+            finally:
+                fp.close()
+            renameFile(tempFileName, self.fileName)
+        except:
+            removeFile(tempFileName)
+            raise
+
+
+class CacheMetadata(JsonFile):
+    '''The HTTP validators (ETag and Last-Modified), SHA-1 digest and fetch
+    time for a cache file, kept as JSON in a sidecar file named after the cache file
+    with .meta appended, along with the last failure to refresh it.'''
+
+    def __init__(self, cache_file_name):
+        JsonFile.__init__(self, cache_file_name + '.meta')
+
+    def failure(self, urls, cache_mtime):
+        '''Return the record of the last failed refresh of the cache file,
+        last modified at cache_mtime, from urls: a dictionary holding its
+        error, the number of failures in a row and the time, retry_at, to
+        try again. Returns None if there is none, or if the cache file or
+        the URLs have changed since, as that failure no longer applies.'''
+        record = self.values.get('failure')
+        if record == None or record.get('urls') != list(urls) or \
+                record.get('cache_mtime') != cache_mtime:
+            return None
+        return record
+
+    def failed(self, urls, cache_mtime, error, max_backoff):
+        '''Record that every one of urls failed to refresh the cache file,
+        last modified at cache_mtime, the last with error. The URLs are left
+        alone for __backoff_base__ seconds, doubling with each failure in a
+        row up to max_backoff seconds. Returns the new record. See failure().'''
+        record   = self.failure(urls, cache_mtime) or dict()
+        failures = record.get('failures', 0) + 1
+        backoff  = min(float(max_backoff), __backoff_base__ * 2 ** (failures - 1))
+        record   = { 'urls'        : list(urls),
+                     'cache_mtime' : cache_mtime,
+                     'failures'    : failures,
+                     'error'       : str(error),
+                     'retry_at'    : time.time() + backoff }
+        self.values['failure'] = record
+        logging.info("Retrying in %d seconds after %d failures" % (backoff, failures))
+        return record
+
+    def identify(self, cache_file_name):
+        '''Record that the stored values describe cache_file_name as it is
+        now. See describes().'''
+        self.values['cache'] = fileIdentity(cache_file_name)
+
+    def describes(self, cache_file_name):
+        '''Return True if the stored values were recorded for cache_file_name
+        as it is now, and not a copy put in its place by someone else.'''
+        identity = fileIdentity(cache_file_name)
+        return identity != None and self.values.get('cache') == identity
+
+
+class CacheTierError(IOError):
+    '''Raised when the cache tier itself cannot be used, as opposed to the
+    server it fetches from.'''
+    pass
+
+
+class CacheTier:
+    '''A second level of cache shared by many hosts, keyed by URL. The
+    location is either a directory, typically on a shared filesystem, or the
+    http(s) URL of a peer serving one with runTierServer(). An entry is
+    fresh for the TTL of the cache it is fetched for, and only one host at a
+    time refreshes a stale entry from its URL.'''
+
+    def __init__(self, location, ttl, lock_timeout=30, compress=False):
+        self.location    = location
+        self.ttl         = ttl
+        self.lockTimeout = lock_timeout
+        self.compress    = compress
+
+    def isPeer(self):
+        '''Return True if the tier is a peer reached over HTTP.'''
+        return self.location.split(':')[0].lower() in ('http', 'https')
+
+    def peerUrl(self, url):
+        '''Return the URL that asks the peer for its copy of url.'''
+        import urllib
+        base = self.location
+        if base.count('/') < 3:
+            base += '/'
+        return '%s?url=%s&ttl=%d' % (base, urllib.quote(url, ''), self.ttl)
+
+    def entry(self, url):
+        '''Return the CacheConfigFile holding the tier\'s copy of url.'''
+        import hashlib
+        return CacheConfigFile(os.path.join(self.location, hashlib.sha1(url).hexdigest()),
+                               self.ttl)
+
+    def refresh(self, url, opener=None):
+        '''Make sure the tier holds a fresh copy of url, fetching it under
+        the entry\'s DirectoryLock if it has expired, and return the entry.
+        Raises CacheTierError if the tier directory cannot be used, and the
+        fetch\'s exception if url fails; a failed fetch leaves the entry
+        as it was.'''
+        if not os.path.isdir(self.location):
+            raise CacheTierError("Cache tier directory not found: %s" % self.location)
+        entry = self.entry(url)
+        if not entry.shouldUpdate():
+            return entry
+        lock = DirectoryLock(entry.fileName + '_')
+        try:
+            try:
+                lock_timeout = self.lockTimeout
+                if opener != None:
+                    lock_timeout = opener.timeouts.limit(lock_timeout)
+                lock.acquire(True, lock_timeout)
+            except DirectoryLockError, error:
+                logging.error("Error acquiring cache tier lock: %s" % error)
+            if not entry.shouldUpdate():
+                # Another host refreshed it while we waited.
+                return entry
+
+            logging.info("Refreshing cache tier entry %s for %s" % (entry.fileName, url))
+            try:
+                temp_file_name     = entry.temporaryFileName()
+                temp_cache_file_fp = openCache(temp_file_name, 'w', self.compress)
+            except (IOError, os.error), e:
+                raise CacheTierError("Cannot write to cache tier: %s" % e)
+            try:
+                try:
+                    metadata   = CacheMetadata(entry.fileName)
+                    validators = downloadConfig(url, entry.fileName, temp_cache_file_fp,
+                                                metadata, opener)
+                finally:
+                    temp_cache_file_fp.close()
+                updateCache(entry, temp_file_name, validators, metadata)
+            except:
+                removeFile(temp_file_name)
+                raise
+            return entry
+        finally:
+            if lock.isLocked:
+                lock.release()
+
+    def fetch(self, url, cache_file, temp_cache_file_fp, metadata=None, opener=None):
+        '''Copy the tier\'s copy of url to the temp cache file, refreshing it
+        first if need be, and return its validators, just as
+        downloadConfig() does for a fetch from url itself. Returns None, and
+        copies nothing, if the cache file is already the tier\'s copy.'''
+        entry  = self.refresh(url, opener)
+        values = CacheMetadata(entry.fileName).values
+        if metadata != None and values.get('etag') and \
+                values.get('etag') == metadata.get('etag') and metadata.describes(cache_file):
+            logging.info("Cached config is the cache tier's copy of %s" % url)
+            return None
+        logging.info("Using cache tier entry %s for %s" % (entry.fileName, url))
+        writeToFile(openCache(entry.fileName), temp_cache_file_fp)
+        return { 'url'           : url,
+                 'etag'          : values.get('etag'),
+                 'last_modified' : values.get('last_modified'),
+                 'digest'        : values.get('digest'),
+                 'size'          : values.get('size') }
+
+
+class UrlHealth(JsonFile):
+    '''How each of the URLs for a cache file has fared lately, kept as JSON
+    in a sidecar file named after the cache file with .health appended. A
+    URL that fails is backed off: skipped until a deadline that doubles
+    with each failure in a row, up to maxBackoff seconds, and then tried
+    again. Safe to update from several threads.'''
+
+    def __init__(self, cache_file_name, max_backoff=600):
+        import threading
+        JsonFile.__init__(self, cache_file_name + '.health')
+        self.maxBackoff = max_backoff
+        self.mutex      = threading.Lock()
+
+    def succeeded(self, url, latency):
+        '''Record that url answered, taking latency seconds.'''
+        self.mutex.acquire()
+        try:
+            record = self.values.get(url, dict())
+            if record.get('latency') != None:
+                # A moving average, so one slow response does not dominate.
+                latency = 0.7 * record['latency'] + 0.3 * latency
+            self.values[url] = { 'failures' : 0, 'latency' : latency }
+        finally:
+            self.mutex.release()
+
+    def failed(self, url, error):
+        '''Record that url failed with error and back it off.'''
+        self.mutex.acquire()
+        try:
+            record   = self.values.get(url, dict())
+            failures = record.get('failures', 0) + 1
+            backoff  = min(float(self.maxBackoff), __backoff_base__ * 2 ** (failures - 1))
+            record.update({ 'failures' : failures,
+                            'error'    : str(error),
+                            'retry_at' : time.time() + backoff })
+            self.values[url] = record
+        finally:
+            self.mutex.release()
+        logging.info("Backing off %s for %d seconds after %d failures" % (url, backoff, failures))
+
+    def arrange(self, urls):
+        '''Return the urls to try now, and messages for those still backed
+        off, which are skipped. The rest keep their order, so a URL whose
+        backoff has run out is tried again in its place in the failover
+        order.'''
+        now      = time.time()
+        ready    = []
+        messages = []
+        for url in urls:
+            record = self.values.get(url, dict())
+            if record.get('failures') and record.get('retry_at', 0) > now:
+                logging.info("Skipping backed off URL %s" % url)
+                retry_at = time.strftime('%H:%M:%S', time.localtime(record['retry_at']))
+                messages.append("%s (skipped until %s)" % (record.get('error'), retry_at))
+            else:
+                ready.append(url)
+        return ready, messages
+
+    def save(self):
+        '''Write the records to the sidecar file, as JsonFile does.'''
+        self.mutex.acquire()
+        try:
+            JsonFile.save(self)
+        finally:
+            self.mutex.release()
+
+
+class AddressCache(JsonFile):
+    '''The addresses each server host resolved to, kept as JSON in the file
+    file_name so later runs need not ask the resolver again. Addresses are
+    used for ttl seconds, and after that only if the resolver fails. Safe to
+    use from several threads.'''
+
+    def __init__(self, file_name, ttl=300):
+        import threading
+        JsonFile.__init__(self, file_name)
+        self.ttl   = float(ttl)
+        self.mutex = threading.Lock()
+
+    def resolve(self, host, port):
+        '''Look up the addresses of host for port and store them. Returns
+        them as socket.getaddrinfo() does. Raises socket.error if the lookup
+        fails.'''
+        import socket
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        self.mutex.acquire()
+        try:
+            self.values['%s:%d' % (host, port)] = { 'addresses' : addresses,
+                                                    'resolved'  : time.time() }
+            try:
+                JsonFile.save(self)
+            except (IOError, os.error), e:
+                logging.error("Error saving address cache: %s" % e)
+        finally:
+            self.mutex.release()
+        return addresses
+
+    def connect(self, address, timeout=None, source_address=None):
+        '''Connect to address, a (host, port) pair, as socket.create_connection()
+        does, trying the stored addresses of host first if they are no older
+        than ttl. If none of them answer, or they are older, host is looked
+        up again; if that fails, old addresses are used all the same.'''
+        import socket
+        host, port = address
+        self.mutex.acquire()
+        try:
+            record = self.values.get('%s:%d' % (host, port))
+        finally:
+            self.mutex.release()
+        tried = []
+        error = None
+        if record != None and time.time() - record['resolved'] < self.ttl:
+            try:
+                return connectAddresses(record['addresses'], timeout, source_address)
+            except socket.error, e:
+                logging.info("Looking up %s again: %s" % (host, e))
+                tried = record['addresses']
+                error = e
+        try:
+            addresses = self.resolve(host, port)
+        except socket.error, e:
+            if record == None or tried:
+                raise
+            logging.error("Using old addresses for %s: %s" % (host, e))
+            addresses = record['addresses']
+        # Only try the addresses that did not just fail. JSON keeps them as
+        # lists rather than tuples.
+        failed    = [list(info[4]) for info in tried]
+        addresses = [info for info in addresses if list(info[4]) not in failed]
+        if len(addresses) == 0:
+            raise error
+        return connectAddresses(addresses, timeout, source_address)
+
+
+class ConfigIndex:
+    '''The macros set in a cache file, so a few of them can be looked up
+    without reading the whole config. Kept in a sidecar file named after the
+    cache file with .index appended: a line identifying the copy of the
+    cache file it was built from, then a "NAME<tab>VALUE" line for each
+    macro, sorted by upper-cased name so lookup() can bisect the file.'''
+
+    def __init__(self, cache_file_name):
+        self.cacheFileName = cache_file_name
+        self.fileName      = cache_file_name + '.index'
+
+    def cacheIdentity(self):
+        '''Return a line identifying this copy of the cache file, from
+        fileIdentity(), so a copy rewritten in place is told apart too.
+        Raises IOError if there is no cache file.'''
+        identity = fileIdentity(self.cacheFileName)
+        if identity == None:
+            raise IOError("No cache file %s" % self.cacheFileName)
+        return identity + '\n'
+
+    def isCurrent(self):
+        '''Return True if the index was built from the cache file as it is.'''
+        try:
+            fp = open(self.fileName, 'rb')
+            try:
+                return fp.readline() == self.cacheIdentity()
+            finally:
+                fp.close()
+        except (IOError, os.error):
+            return False
+
+    def build(self):
+        '''Index the cache file as it is now, replacing the index in one
+        atomic rename. Raises IOError if either file cannot be used.'''
+        import tempfile
+        identity = self.cacheIdentity()
+        cache_fp = openCache(self.cacheFileName)
+        try:
+            macros = parseConfig(cache_fp)
+        finally:
+            cache_fp.close()
+        names = macros.keys()
+        names.sort()
+        directory, base = os.path.split(os.path.abspath(self.fileName))
+        fd, tempFileName = tempfile.mkstemp('', base + '.', directory)
+        try:
+            fp = os.fdopen(fd, 'wb')
+            try:
+                fp.write(identity)
+                for name in names:
+                    fp.write('%s\t%s\n' % macros[name])
+            finally:
+                fp.close()
+            renameFile(tempFileName, self.fileName)
+        except:
+            removeFile(tempFileName)
+            raise
+
+    def lookup(self, names):
+        '''Return the macros in names that are set, as a dictionary of
+        upper-cased name to (name, value). Raises IOError if there is no
+        index.'''
+        found = dict()
+        fp    = open(self.fileName, 'rb')
+        try:
+            start = len(fp.readline())
+            fp.seek(0, 2)
+            size  = fp.tell()
+            for name in names:
+                target = name.upper()
+                # Narrow down to a block that must hold target's line, if
+                # there is one, then read through that block.
+                low, high = start, size
+                while high - low > __chunk_size__ / 16:
+                    middle = (low + high) / 2
+                    fp.seek(middle)
+                    fp.readline()
+                    line = fp.readline()
+                    if line == '' or line.split('\t', 1)[0].upper() >= target:
+                        high = middle
+                    else:
+                        low = middle
+                fp.seek(low)
+                if low > start:
+                    fp.readline()
+                for line in iter(fp.readline, ''):
+                    key, value = line.rstrip('\n').split('\t', 1)
+                    if key.upper() >= target:
+                        if key.upper() == target:
+                            found[target] = (key, value)
+                        break
+        finally:
+            fp.close()
+        return found
+
+
+class RunMetrics:
+    '''How a run went, saved as one JSON record when it ends: when it
+    started, its mode, exit status and length, the cache's age, time spent
+    on locks, bytes received, each URL attempt and where each config was
+    served from. Safe to update from several threads.'''
+
+    def __init__(self, path, mode='config'):
+        # The lock from thread, unlike threading, costs a cache hit nothing
+        # to import.
+        import thread
+        self.path   = path
+        self.mutex  = thread.allocate_lock()
+        self.values = { 'time'      : time.time(),
+                        'mode'      : mode,
+                        'lock_wait' : 0.0,
+                        'bytes'     : 0,
+                        'attempts'  : [],
+                        'served'    : dict() }
+
+    def update(self, values):
+        '''Store the keys and values in the dictionary values.'''
+        self.mutex.acquire()
+        try:
+            self.values.update(values)
+        finally:
+            self.mutex.release()
+
+    def add(self, key, amount):
+        '''Add amount to the number stored for key.'''
+        self.mutex.acquire()
+        try:
+            self.values[key] += amount
+        finally:
+            self.mutex.release()
+
+    def attempt(self, url, seconds, result, error=None):
+        '''Record a request to url that took seconds, with result
+        'modified', 'not_modified' or 'error'.'''
+        record = { 'url' : url, 'seconds' : seconds, 'result' : result }
+        if error != None:
+            record['error'] = str(error)
+        self.mutex.acquire()
+        try:
+            self.values['attempts'].append(record)
+        finally:
+            self.mutex.release()
+
+    def served(self, source):
+        '''Count a config served from source: 'hit' for an unexpired cache,
+        'refreshed', 'stale', 'daemon' or 'failed' when there was none.'''
+        self.mutex.acquire()
+        try:
+            served = self.values['served']
+            served[source] = served.get(source, 0) + 1
+        finally:
+            self.mutex.release()
+
+    def save(self, status):
+        '''Finish the record with the exit status and append it to the
+        metrics file as a line of JSON, in a single write so records from
+        runs that end together are not interleaved. If the path is a Unix
+        socket, the record is sent to it as a datagram instead.'''
+        import json
+        import stat
+        self.values.update({ 'status'  : status or 0,
+                             'seconds' : time.time() - self.values['time'] })
+        record = json.dumps(self.values) + '\n'
+        if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+            import socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                sock.sendto(record, self.path)
+            finally:
+                sock.close()
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+
+
+class ConfigDaemon:
+    '''A resident server for one cache file. It keeps the config text in
+    memory, refreshes it on the cache\'s TTL schedule in a background thread
+    and hands it to clients connecting on a Unix-domain socket.'''
+
+    def __init__(self, socket_name, cache_config_file, config_urls, lock_timeout, options):
+        self.socketName      = socket_name
+        self.cacheConfigFile = cache_config_file
+        self.configUrls      = config_urls
+        self.lockTimeout     = lock_timeout
+        self.options         = options
+        self.cacheFileName   = os.path.abspath(cache_config_file.fileName)
+        self.output          = None
+        self.listener        = None
+
+    def refresh(self):
+        '''Refresh the cache file if its TTL has expired and reload the
+        config text held in memory. With the metrics option each refresh is
+        saved as a record of its own.'''
+        import cStringIO
+        startMetrics(self.options, 'daemon')
+        status = 1
+        try:
+            header, file_name = loadConfig(self.cacheConfigFile, self.configUrls,
+                                           self.lockTimeout, None, self.options)
+            output = cStringIO.StringIO()
+            writeConfig(header, file_name, output)
+            self.output = output.getvalue()
+            status = 0
+        finally:
+            saveMetrics(status)
+
+    def refreshLoop(self):
+        '''Refresh the config as refreshForever() schedules it. Never
+        returns.'''
+        refreshForever(self.cacheConfigFile, self.configUrls, self.lockTimeout,
+                       self.refresh, self.options)
+
+    def listen(self):
+        '''Bind the Unix socket, replacing a socket file left behind by a
+        daemon that is no longer running. Raises socket.error if another
+        daemon is answering on it.'''
+        import socket
+        if os.path.exists(self.socketName):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                try:
+                    probe.connect(self.socketName)
+                except socket.error:
+                    os.remove(self.socketName)
+                else:
+                    raise socket.error("A daemon is already running on %s" % self.socketName)
+            finally:
+                probe.close()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Wait for clients indefinitely, not for the default socket timeout.
+        self.listener.settimeout(None)
+        self.listener.bind(self.socketName)
+        # Any user's condor_* command may ask for the config, just as any
+        # user may read the cache file.
+        os.chmod(self.socketName, 0666)
+        self.listener.listen(64)
+        logging.info("Daemon listening on %s" % self.socketName)
+
+    def serveForever(self):
+        '''Answer client requests until the process is stopped. A request is
+        the absolute cache file name followed by a newline; the reply is the
+        config text, or nothing if the request names another cache file.'''
+        import socket
+        import threading
+        self.refresh()
+        refresher = threading.Thread(target=self.refreshLoop)
+        refresher.setDaemon(True)
+        refresher.start()
+        while True:
+            client, address = self.listener.accept()
+            try:
+                try:
+                    client.settimeout(__timeout__)
+                    request = ''
+                    while request.find('\n') == -1 and len(request) < 4096:
+                        data = client.recv(4096)
+                        if not data:
+                            break
+                        request += data
+                    output = self.output
+                    if request.strip() == self.cacheFileName and output != None:
+                        client.sendall(output)
+                except socket.error, e:
+                    logging.error("Error answering daemon client: %s" % e)
+            finally:
+                client.close()
+
+    def close(self):
+        '''Stop listening and remove the socket file.'''
+        if self.listener != None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.remove(self.socketName)
+            except os.error:
+                pass
+
+
+
+################################################################################
+# METHODS
+################################################################################
+
+def writeToFile(in_fp, out_fp, strip_errors=False):
+    '''Copy bits from in_fp to out_fp in chunks of __chunk_size__ bytes, so
+    memory use does not grow with the config. With strip_errors, any
+    CONFIG_FILE_ERROR line and the blank line after it are left out. Closes
+    in_fp at the end. Returns the number of bytes written.'''
+    written = 0
+    try:
+        if strip_errors:
+            skip_next = False
+            for current_line in in_fp:
+                if skip_next:
+                    # skip this line but not the one after this
+                    skip_next = False
+                elif current_line.find("CONFIG_FILE_ERROR") != -1:
+                    # do nothing on this line, and skip the next blank line too
+                    skip_next = True
+                else:
+                    out_fp.write(current_line)
+                    written += len(current_line)
+            return written
+
+        chunk = in_fp.read(__chunk_size__)
+        while chunk != '':
+            out_fp.write(chunk)
+            written += len(chunk)
+            chunk = in_fp.read(__chunk_size__)
+        return written
+    finally:
+        in_fp.close()
+
+
+def setupLogging():
+    '''Configure logging for the level chosen by _CACHE_TOOL_DEBUG. Safe to
+    call more than once.'''
+    if not logging.root.handlers:
+        logging.basicConfig(level=logLevel,
+                            format='%(asctime)s %(levelname)-8s %(message)s',
+                            datefmt='%a, %d %b %Y %H:%M:%S',
+                            stream=sys.stderr)
+
+
+def setupNetwork(options=option_defaults):
+    '''Prepare the process for fetching configs, with the AddressCache chosen
+    in options. Only a refresh needs this.'''
+    global __resolver__
+    import socket
+    socket.setdefaulttimeout(__timeout__)
+    if options['dns-cache'] != None:
+        __resolver__ = AddressCache(options['dns-cache'], float(options['dns-ttl']))
+
+    # PROXY CONFIGURATION
+    # Python http_proxy incompatibility for http_proxy:
+    #   handle the case where it does not start with http://
+    for http_proxy in ['http_proxy', 'HTTP_PROXY']:
+        if os.environ.has_key(http_proxy) and os.environ[http_proxy][:7] != "http://":
+            os.environ[http_proxy] = "http://"+os.environ[http_proxy]
+            break
+
+
+def connectAddresses(addresses, timeout=None, source_address=None):
+    '''Connect to the first of addresses, as socket.getaddrinfo() returns
+    them, that answers, as socket.create_connection() does. Returns the
+    socket. Raises the socket.error of the last address tried.'''
+    import socket
+    error = socket.error("No addresses to connect to")
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if timeout != None and timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(tuple(sockaddr))
+            return sock
+        except socket.error, e:
+            error = e
+            if sock != None:
+                sock.close()
+    raise error
+
+
+def flockModule():
+    '''Return the fcntl module, or None on platforms without it (Windows),
+    where DirectoryLock falls back to its lock directory.'''
+    try:
+        import fcntl
+        return fcntl
+    except ImportError:
+        return None
+
+
+def zstdModule():
+    '''Return the optional zstandard module, or None if it is not installed.'''
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+def acceptEncoding():
+    '''Return the Accept-Encoding header value for the compressed responses
+    DecodingReader can decode.'''
+    if zstdModule() != None:
+        return 'zstd, gzip, deflate'
+    return 'gzip, deflate'
+
+
+def openCache(file_name, mode='r', compress=False):
+    '''Open a cache file, or a temp file that will become one, for reading
+    (mode 'r') or writing (mode 'w'). Mode 'rb' reads the bytes as they
+    were written, without translating line endings. A cache written with
+    compress is gzip-compressed; reading one decompresses it, whichever way
+    it was written.'''
+    if mode == 'w':
+        if compress:
+            import gzip
+            return gzip.GzipFile(file_name, 'wb', 6)
+        return open(file_name, 'w')
+    fp = open(file_name, 'rb')
+    try:
+        magic = fp.read(2)
+    finally:
+        fp.close()
+    if magic == '\x1f\x8b':
+        import gzip
+        return gzip.GzipFile(file_name, 'rb')
+    if mode == 'rb':
+        return open(file_name, 'rb')
+    return open(file_name, 'rU')
+
+
+def writeConfig(header, file_name, out_fp):
+    '''Write the config HTCondor is given to out_fp: the header, then the
+    contents of file_name, sent by sendCache() if possible and streamed in
+    chunks otherwise. Only the header is written if file_name is None or
+    cannot be read.'''
+    out_fp.write(header)
+    if file_name == None:
+        return
+    try:
+        if header.find("CONFIG_FILE_ERROR") != -1:
+            # A cache written by an earlier version may embed the error of
+            # the refresh that last failed, which would override the header.
+            writeToFile(openCache(file_name), out_fp, strip_errors=True)
+        elif not sendCache(file_name, out_fp):
+            writeToFile(openCache(file_name), out_fp)
+    except (IOError, os.error), e:
+        logging.error("Error reading cached config: %s" % e)
+        return
+    out_fp.write('\n')
+
+
+def fileDigest(file_name):
+    '''Return the SHA-1 digest, in hex, of the config in file_name, or None
+    if it cannot be read.'''
+    try:
+        cache_fp = DigestReader(openCache(file_name, 'rb'))
+    except IOError:
+        return None
+    try:
+        while cache_fp.read() != '':
+            pass
+    finally:
+        cache_fp.close()
+    return cache_fp.hexdigest()
+
+
+def parseConfig(lines):
+    '''Return the macros set by the HTCondor config in lines, as a dictionary
+    of upper-cased name to (name, value). Lines ending in a backslash are
+    joined to the next, as HTCondor does, and a later setting of a macro
+    replaces an earlier one. Other statements, such as conditionals and
+    includes, are passed over and values are not expanded.'''
+    import re
+    macros  = dict()
+    pending = ''
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.endswith('\\'):
+            pending += line[:-1]
+            continue
+        line    = (pending + line).strip()
+        pending = ''
+        match   = re.match(r'([\w.\-]+)\s*=(.*)$', line)
+        if match != None:
+            name = match.group(1)
+            macros[name.upper()] = (name, match.group(2).strip())
+    return macros
+
+
+def updateIndex(cache_file_name):
+    '''Rebuild the ConfigIndex of a newly written cache file, if it has one.
+    A cache that is never queried is never indexed.'''
+    index = ConfigIndex(cache_file_name)
+    if not os.path.exists(index.fileName):
+        return
+    try:
+        index.build()
+    except (IOError, os.error), e:
+        logging.error("Error indexing cached config: %s" % e)
+        removeFile(index.fileName)
+
+
+def writeQuery(header, file_name, names, out_fp):
+    '''Write the settings of the macros in names to out_fp, in place of the
+    config, from the ConfigIndex of file_name, built first if need be. A
+    CONFIG_FILE_ERROR in header replaces any in the cache file. Macros that
+    are not set are left out.'''
+    macros = dict()
+    if file_name != None and os.path.exists(file_name):
+        index = ConfigIndex(file_name)
+        try:
+            if not index.isCurrent():
+                logging.info("Indexing cached config %s" % file_name)
+                index.build()
+            macros.update(index.lookup(names))
+        except (IOError, os.error), e:
+            # Fall back on reading the whole config.
+            logging.error("Error indexing cached config: %s" % e)
+            cache_fp = openCache(file_name)
+            try:
+                macros.update(parseConfig(cache_fp))
+            finally:
+                cache_fp.close()
+    macros.update(parseConfig(header.splitlines()))
+    for name in names:
+        if macros.has_key(name.upper()):
+            out_fp.write('%s = %s\n' % tuple(macros[name.upper()]))
+
+
+def writeDigest(file_name, out_fp):
+    '''Write the digest of the config in file_name to out_fp in place of the
+    config, so a wrapper can tell whether it changed since the last run.
+    Nothing is written if there is no config. See fileDigest().'''
+    digest = None
+    if file_name != None:
+        digest = fileDigest(file_name)
+    if digest != None:
+        out_fp.write(digest + '\n')
+
+
+def buildOpener(pool=None, timeouts=None, watch=None):
+    '''Build the urllib2 opener for configs, waiting on servers as long as
+    timeouts, a Timeouts kept as its timeouts attribute, allows. Given pool,
+    a ConnectionPool, connections are kept open for the next request. Given
+    watch, servers are asked to hold requests open for up to watch seconds;
+    the opener's watcher attribute tells whether the last one did.'''
+    import httplib
+    import urllib2
+
+    if timeouts == None:
+        timeouts = Timeouts()
+
+    class CustomHttpHandler(urllib2.BaseHandler):
+        '''Handler helper class for dealing with URL requests.'''
+
+        def http_error_304(self, req, fp, code, msg, hdrs):
+            fp.close()
+            raise NotModified(msg)
+
+    class WatchHandler(urllib2.BaseHandler):
+        '''Ask for a long poll on conditional requests and note whether
+        the server applied it, on a 304 Not Modified as on any other
+        response.'''
+
+        waited = False
+
+        def http_request(self, req):
+            if req.has_header('If-modified-since'):
+                req.add_header('Prefer', 'wait=%d' % watch)
+            return req
+
+        def http_response(self, req, response):
+            applied     = response.info().getheader('Preference-Applied') or ''
+            self.waited = applied.find('wait') != -1
+            return response
+
+        https_request  = http_request
+        https_response = http_response
+
+    # urllib2 gives a connection one timeout, which it uses for connecting
+    # and then for every read. Switch to the read timeout once connected.
+    class TimedHTTPConnection(httplib.HTTPConnection):
+        def readTimeout(self):
+            return timeouts.limit(timeouts.read)
+
+        def connect(self):
+            if __resolver__ != None:
+                self._create_connection = __resolver__.connect
+            httplib.HTTPConnection.connect(self)
+            self.sock.settimeout(self.readTimeout())
+            if timeouts.deadline != None:
+                self.sock = DeadlineSocket(self.sock, timeouts)
+
+    class TimedHttpHandler(urllib2.HTTPHandler):
+        '''Open http requests on TimedHTTPConnections, from pool if given.'''
+
+        def http_open(self, req):
+            if pool != None:
+                return pool.open(TimedHTTPConnection, req)
+            return self.do_open(TimedHTTPConnection, req)
+
+    handlers = [CustomHttpHandler(), TimedHttpHandler()]
+    if hasattr(urllib2, 'HTTPSHandler'):
+        class TimedHTTPSConnection(httplib.HTTPSConnection):
+            def readTimeout(self):
+                return timeouts.limit(timeouts.read)
+
+            def connect(self):
+                if __resolver__ != None:
+                    self._create_connection = __resolver__.connect
+                httplib.HTTPSConnection.connect(self)
+                self.sock.settimeout(self.readTimeout())
+                if timeouts.deadline != None:
+                    self.sock = DeadlineSocket(self.sock, timeouts)
+
+        class TimedHttpsHandler(urllib2.HTTPSHandler):
+            '''Open https requests on TimedHTTPSConnections, from pool if
+            given.'''
+
+            def https_open(self, req):
+                if pool != None:
+                    return pool.open(TimedHTTPSConnection, req)
+                if hasattr(self, '_context'):
+                    return self.do_open(TimedHTTPSConnection, req, context=self._context)
+                return self.do_open(TimedHTTPSConnection, req)
+
+        handlers.append(TimedHttpsHandler())
+
+    watcher = None
+    if watch != None:
+        watcher = WatchHandler()
+        handlers.append(watcher)
+
+    opener            = urllib2.build_opener(*handlers)
+    opener.addheaders = [('User-agent', 'CacheConfig/%s' % __version__),
+                         ('Accept-Encoding', acceptEncoding())]
+    opener.timeouts   = timeouts
+    opener.watcher    = watcher
+    return opener
+
+
+def openConfigUrl(request_url, url, cache_file, metadata, opener):
+    '''Request the config for url from request_url, url itself or a cache
+    tier peer, with opener. Given cache_file, the request is conditional on
+    metadata, its CacheMetadata, and offers to take a delta. Returns the
+    response. Raises NotModified if the cached copy is still current, and
+    DeadlineExceeded once the deadline of the opener's timeouts has passed.'''
+    import urllib2
+    opener.timeouts.check()
+    req = urllib2.Request(url=request_url)
+    if cache_file != None and os.path.exists(cache_file):
+        # Tell the server which copy we have. It may elect to return a
+        # no-change message if the config hasn't actually changed.
+        # Saving us time moving data over the wire. Prefer the
+        # server's own validators to the time we wrote the cache.
+        last_modified = None
+        if metadata != None and metadata.get('url') == url and metadata.describes(cache_file):
+            if metadata.get('etag'):
+                req.add_header("If-None-Match", metadata.get('etag'))
+            last_modified = metadata.get('last_modified')
+        if not last_modified:
+            modified = time.gmtime(os.path.getmtime(cache_file))
+            RFC_1123_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+            last_modified = time.strftime(RFC_1123_FORMAT, modified)
+        req.add_header("If-Modified-Since", last_modified)
+        # Offer to take the changes to our copy instead of the whole config.
+        # The digest names our copy whichever URL it came from.
+        if metadata != None and metadata.get('digest'):
+            req.add_header("A-IM", "diffe")
+            req.add_header("X-Config-Digest", metadata.get('digest'))
+    return opener.open(req, timeout=opener.timeouts.limit(opener.timeouts.connect))
+
+
+def fetchConfig(url, cache_file, temp_cache_file_fp, metadata, opener, tier=None):
+    '''Fetch the config at url in to the temp cache file with opener,
+    conditional on metadata and through tier if it can be reached. Returns
+    the validators for the new copy, or None if the server says the cached
+    copy is still current. Raises an Exception if the download fails.'''
+    import urllib2
+
+    if tier != None and not tier.isPeer():
+        try:
+            return tier.fetch(url, cache_file, temp_cache_file_fp, metadata, opener)
+        except CacheTierError, e:
+            logging.error("Fetching %s without the cache tier: %s" % (url, e))
+    try:
+        url_fp = None
+        if tier != None and tier.isPeer():
+            try:
+                url_fp = openConfigUrl(tier.peerUrl(url), url, cache_file, metadata, opener)
+            except NotModified:
+                raise
+            except Exception, e:
+                if isinstance(e, urllib2.HTTPError):
+                    e.close()
+                logging.error("Fetching %s without the cache tier: %s" % (url, e))
+        if url_fp == None:
+            url_fp = openConfigUrl(url, url, cache_file, metadata, opener)
+    except NotModified:
+        logging.info("Cached config is still current at %s" % url)
+        return None
+    headers, body_fp = readResponse(url_fp, opener)
+    if url_fp.code == 226:
+        # 226 IM Used: the body is a delta to the cached copy.
+        try:
+            return patchConfig(url, cache_file, temp_cache_file_fp, body_fp, headers)
+        except DeltaError, e:
+            logging.error("Fetching all of %s: %s" % (url, e))
+        headers, body_fp = readResponse(openConfigUrl(url, url, None, None, opener), opener)
+    # Servers that ignore If-Modified-Since send the whole config every
+    # time. A body that may be the cached copy over again is held back
+    # until its digest, checked against the one stored for the cached
+    # copy, says whether it is.
+    body_fp = DigestReader(body_fp)
+    out_fp  = temp_cache_file_fp
+    if metadata != None and metadata.get('digest') and metadata.get('size') != None and \
+            metadata.describes(cache_file):
+        out_fp = HeldWriter(temp_cache_file_fp, metadata.get('size'))
+    size       = writeToFile(body_fp, out_fp)
+    validators = { 'url'           : url,
+                   'etag'          : headers.getheader('ETag'),
+                   'last_modified' : headers.getheader('Last-Modified'),
+                   'digest'        : body_fp.hexdigest(),
+                   'size'          : size }
+    if out_fp != temp_cache_file_fp:
+        if size == metadata.get('size') and validators['digest'] == metadata.get('digest'):
+            logging.info("Cached config is unchanged at %s" % url)
+            out_fp.discard()
+            validators['unchanged'] = True
+        else:
+            out_fp.release()
+    return validators
+
+
+def readResponse(url_fp, opener):
+    '''Return the headers of the response url_fp and a file-like object
+    reading its body, decoded and held to the deadline of the timeouts of
+    opener.'''
+    headers = url_fp.info()
+    body_fp = url_fp
+    if __metrics__ != None:
+        body_fp = MeteredReader(body_fp, __metrics__)
+    if opener.timeouts.deadline != None:
+        body_fp = DeadlineReader(body_fp, opener.timeouts)
+    encoding = (headers.getheader('Content-Encoding') or 'identity').strip().lower()
+    if encoding != 'identity':
+        logging.info("Decoding %s response" % encoding)
+        body_fp = DecodingReader(body_fp, encoding)
+    return headers, body_fp
+
+
+def parseDelta(delta_fp):
+    '''Read a "diff -e" delta (an ed script) from delta_fp, closing it, and
+    return its commands in line order as (first, last, lines) tuples, each
+    replacing lines first to last of the cached copy; an append after line n
+    is (n + 1, n, lines). Raises DeltaError if it is not such a script or
+    its commands overlap.'''
+    import re
+    try:
+        script = ''.join(iter(lambda: delta_fp.read(__chunk_size__), ''))
+    finally:
+        delta_fp.close()
+    commands = []
+    # Split on newlines alone, so that lines added to a CRLF config keep
+    # their carriage returns.
+    lines    = iter(re.findall(r'[^\n]*\n|[^\n]+$', script))
+    for line in lines:
+        line  = line.rstrip('\r\n')
+        match = re.match(r'(\d+)(?:,(\d+))?([acd])$', line)
+        if match == None:
+            raise DeltaError("Unknown delta command: %s" % line[:40])
+        first = int(match.group(1))
+        last  = int(match.group(2) or first)
+        if match.group(3) == 'a':
+            first, last = first + 1, first
+        elif first < 1 or last < first:
+            raise DeltaError("Bad line range in delta command: %s" % line)
+        text = []
+        if match.group(3) != 'd':
+            for line in lines:
+                if line.rstrip('\r\n') == '.':
+                    break
+                if not line.endswith('\n'):
+                    line += '\n'
+                text.append(line)
+            else:
+                raise DeltaError("Delta ends in the middle of a command")
+        commands.append((first, last, text))
+    commands.sort(key=lambda command: command[:2])
+    for index in range(1, len(commands)):
+        if commands[index][0] <= commands[index - 1][1] or \
+                commands[index][:2] == commands[index - 1][:2]:
+            raise DeltaError("Delta commands overlap")
+    return commands
+
+
+def applyDelta(commands, base_fp, out_fp=None):
+    '''Stream the config in base_fp to out_fp, if given, with the commands
+    from parseDelta() applied, and return the SHA-1 digest, in hex, of the
+    result. Closes base_fp. Raises DeltaError if the commands go past the
+    end of the config.'''
+    import hashlib
+    digest = hashlib.sha1()
+
+    def write(data):
+        digest.update(data)
+        if out_fp != None:
+            out_fp.write(data)
+
+    try:
+        number = 0
+        for first, last, text in commands:
+            while number < last:
+                line = base_fp.readline()
+                if line == '':
+                    raise DeltaError("Delta goes past the end of the cached config")
+                number += 1
+                if number < first:
+                    write(line)
+            for line in text:
+                write(line)
+        chunk = base_fp.read(__chunk_size__)
+        while chunk != '':
+            write(chunk)
+            chunk = base_fp.read(__chunk_size__)
+    finally:
+        base_fp.close()
+    return digest.hexdigest()
+
+
+def patchConfig(url, cache_file, temp_cache_file_fp, delta_fp, headers):
+    '''Write the config for url to the temp cache file by applying the delta
+    in delta_fp, with the response headers, to the cached copy in
+    cache_file. Returns the validators, as fetchConfig() does. Raises
+    DeltaError, having written nothing, if the delta does not apply or the
+    result does not match the server's digest.'''
+    try:
+        im = (headers.getheader('IM') or '').strip().lower()
+        if im != 'diffe':
+            raise DeltaError("Unknown delta format: %s" % im)
+        digest = (headers.getheader('X-Config-Digest') or '').strip().lower()
+        if not digest:
+            raise DeltaError("No digest sent with the delta")
+    except:
+        delta_fp.close()
+        raise
+    commands = parseDelta(delta_fp)
+    if applyDelta(commands, openCache(cache_file, 'rb')) != digest:
+        raise DeltaError("Delta does not apply to the cached config")
+    logging.info("Applying a delta of %d changes from %s" % (len(commands), url))
+    if applyDelta(commands, openCache(cache_file, 'rb'), temp_cache_file_fp) != digest:
+        raise IOError("Cached config changed while the delta was applied")
+    return { 'url'           : url,
+             'etag'          : headers.getheader('ETag'),
+             'last_modified' : headers.getheader('Last-Modified'),
+             'digest'        : digest }
+
+
+def downloadConfig(url, cache_file, temp_cache_file_fp, metadata=None, opener=None,
+                   tier=None, health=None):
+    '''Fetch a config using a URL as the source for the config and
+    cache it locally on disk, as fetchConfig() does, recording the outcome
+    in health if given. Returns the validators for the new copy, or None if
+    the cached copy is still current. Raises an Exception if there is a
+    problem downloading the contents.'''
+    import urllib2
+
+    if opener == None:
+        opener = buildOpener()
+
+    start = time.time()
+    try:
+        validators = fetchConfig(url, cache_file, temp_cache_file_fp, metadata, opener, tier)
+    except Exception, e:
+        if isinstance(e, urllib2.HTTPError):
+            # Finished with the error response, so its connection is free.
+            e.close()
+        if health != None:
+            health.failed(url, e)
+        if __metrics__ != None:
+            __metrics__.attempt(url, time.time() - start, 'error', e)
+        raise e
+    if health != None:
+        health.succeeded(url, time.time() - start)
+    if __metrics__ != None:
+        result = 'modified'
+        if validators == None:
+            result = 'not_modified'
+        __metrics__.attempt(url, time.time() - start, result)
+    return validators
+
+
+def fileIdentity(file_name):
+    '''Return a string that changes whenever file_name is replaced or
+    modified: its inode, size and modification time. Returns None if the
+    file does not exist.'''
+    try:
+        stat = os.stat(file_name)
+    except os.error:
+        return None
+    return '%d %d %r' % (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def removeFile(file_name):
+    '''Remove a file if it exists, ignoring any error doing so.'''
+    try:
+        if file_name != None and os.path.isfile(file_name):
+            os.remove(file_name)
+    except os.error:
+        pass
+
+
+def renameFile(old_name, new_name):
+    '''Rename old_name to new_name in one atomic step, replacing new_name if
+    it exists.'''
+    if os.name == 'nt':
+        # os.rename() will not replace an existing file on Windows.
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        MOVEFILE_WRITE_THROUGH    = 0x8
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(old_name), unicode(new_name),
+                MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+            raise ctypes.WinError()
+    else:
+        os.rename(old_name, new_name)
+
+
+def syncFile(file_name):
+    '''Flush the contents of file_name to disk.'''
+    fp = open(file_name, 'a')
+    try:
+        os.fsync(fp.fileno())
+    finally:
+        fp.close()
+
+
+def syncDirectory(directory_name):
+    '''Flush the entries of directory_name, such as a rename, to disk. Only
+    possible on POSIX systems.'''
+    if os.name == 'nt':
+        return
+    fd = os.open(directory_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def installCache(cache_config_file, temp_file_name, sync=False):
+    '''Move a fully written temp cache file in to place as the cache file
+    with a single rename, so a reader sees either the old or the new cache
+    and never a partly written one. With sync, the temp file and then the
+    rename are flushed to disk.'''
+    if sync:
+        syncFile(temp_file_name)
+    logging.info("Renaming tempCacheConfig file to cacheFile")
+    renameFile(temp_file_name, cache_config_file.fileName)
+    if sync:
+        syncDirectory(os.path.dirname(os.path.abspath(cache_config_file.fileName)))
+
+
+def touchCache(cache_config_file):
+    '''Restart the TTL of the cache file without changing its contents.'''
+    try:
+        os.utime(cache_config_file.fileName, None)
+    except os.error, e:
+        # Only the owner may set the time of a file it cannot write to, so
+        # fall back on installing a copy of it that we own.
+        logging.info("Rewriting cache file to touch it: %s" % e)
+        temp_file_name     = cache_config_file.temporaryFileName()
+        temp_cache_file_fp = open(temp_file_name, 'wb')
+        try:
+            writeToFile(open(cache_config_file.fileName, 'rb'), temp_cache_file_fp)
+        finally:
+            temp_cache_file_fp.close()
+        installCache(cache_config_file, temp_file_name)
+
+
+def updateCache(cache_config_file, temp_file_name, validators, metadata, sync=False):
+    '''Put the result of downloadConfig() in to effect. If validators is None,
+    or they show the server sent the cached copy again, the temp cache file
+    is discarded and the cache file only touched; otherwise it is installed
+    with sync and validators recorded in metadata. Either way any recorded
+    failure is forgotten.'''
+    if validators == None:
+        removeFile(temp_file_name)
+        touchCache(cache_config_file)
+        if metadata.get('url') or metadata.get('failure'):
+            metadata.update({ 'fetched' : time.time(), 'failure' : None })
+            metadata.identify(cache_config_file.fileName)
+            metadata.save()
+        return
+
+    # The stored digest is only that of the cache file if nobody has put
+    # another copy in its place since. fetchConfig() has checked already
+    # if it held the body back, and then wrote none of it.
+    unchanged = validators.pop('unchanged', False)
+    digest    = validators.get('digest')
+    if unchanged or (digest and digest == metadata.get('digest') and \
+            metadata.describes(cache_config_file.fileName)):
+        logging.info("Cached config is unchanged")
+        removeFile(temp_file_name)
+        touchCache(cache_config_file)
+        metadata.update(validators)
+        metadata.update({ 'fetched' : time.time(), 'failure' : None })
+        metadata.identify(cache_config_file.fileName)
+        metadata.save()
+        return
+
+    # Drop the old validators first so they never describe the new copy.
+    metadata.remove()
+    installCache(cache_config_file, temp_file_name, sync)
+    updateIndex(cache_config_file.fileName)
+    if validators:
+        metadata.update(validators)
+        metadata.update({ 'fetched' : time.time() })
+        metadata.identify(cache_config_file.fileName)
+        metadata.save()
+
+
+def raceConfig(cache_config_file, config_urls, stagger, metadata, options=option_defaults,
+               opener=None, tier=None, health=None):
+    '''Fetch the config from all of config_urls in parallel, each starting
+    stagger seconds after the one before or as soon as it fails, installing
+    the first good response and cancelling the rest, as loadConfig() would.
+    Returns whether a copy was installed and the messages of the URLs that
+    failed before it. Raises DeadlineExceeded if the deadline passes first.'''
+    import threading
+    import Queue
+
+    if opener == None:
+        opener = buildOpener()
+    timeouts = opener.timeouts
+
+    results    = Queue.Queue()
+    cancelled  = threading.Event()
+    outcome    = dict() # the winner's index, set before cancelled is
+    temp_names = [cache_config_file.temporaryFileName('.%d' % i) for i in range(len(config_urls))]
+
+    def fetch(index):
+        temp_file_name = temp_names[index]
+        try:
+            temp_cache_file_fp = openCache(temp_file_name, 'w', options['compress-cache'])
+            try:
+                validators = downloadConfig(config_urls[index], \
+                        cache_config_file.fileName, temp_cache_file_fp, metadata,
+                        opener, tier, health)
+            finally:
+                temp_cache_file_fp.close()
+            results.put((index, None, validators))
+        except Exception, e:
+            results.put((index, e, None))
+            removeFile(temp_file_name)
+        if cancelled.isSet() and outcome.get('winner') != index:
+            # Lost the race; nobody will install this copy.
+            removeFile(temp_file_name)
+
+    started    = 0
+    finished   = 0
+    next_start = time.time()
+    errors     = dict()
+    winner     = None
+    while winner == None and finished < len(config_urls) and not timeouts.expired():
+        if started < len(config_urls) and \
+                (time.time() >= next_start or finished == started):
+            logging.info("Racing URL #%d: %s" % (started+1, config_urls[started]))
+            fetcher = threading.Thread(target=fetch, args=(started,))
+            # An urllib2 request cannot be interrupted once it is under
+            # way, so a cancelled fetch is left to finish on its own.
+            fetcher.setDaemon(True)
+            fetcher.start()
+            started   += 1
+            next_start = time.time() + stagger
+            continue
+        try:
+            wait = None
+            if started < len(config_urls):
+                wait = max(0.0, next_start - time.time())
+            remaining = timeouts.remaining()
+            if remaining != None and (wait == None or remaining < wait):
+                wait = remaining
+            if wait == None:
+                result = results.get()
+            else:
+                result = results.get(True, wait)
+        except Queue.Empty:
+            continue
+        finished += 1
+        index, error, validators = result
+        if error == None:
+            winner = index
+        else:
+            logging.error("Exception updating config from URL #%d: %s" % (index+1, error))
+            errors[index] = error
+    outcome['winner'] = winner
+    cancelled.set()
+    for index in range(len(config_urls)):
+        if index != winner:
+            removeFile(temp_names[index])
+
+    if winner != None:
+        logging.info("URL #%d won the race" % (winner+1))
+        updateCache(cache_config_file, temp_names[winner], validators, metadata,
+                    options['fsync'])
+        return True, [str(errors[i]) for i in sorted(errors.keys()) if i < winner]
+
+    if finished < len(config_urls):
+        # Out of time with URLs still out.
+        try:
+            timeouts.check()
+        except DeadlineExceeded, e:
+            messages = [str(errors[i]) for i in sorted(errors.keys())] + [str(e)]
+            raise DeadlineExceeded("; ".join(messages))
+
+    return False, [str(errors[i]) for i in range(len(config_urls))]
+
+
+def createCacheConfigFile(file_name, ttl, options=option_defaults):
+    '''Return a CacheConfigFile for file_name with the given TTL and the TTL
+    jitter and early refresh chosen in options. Raises ValueError if either
+    option is not valid.'''
+    return CacheConfigFile(file_name, ttl, ttlJitter(options),
+                           earlyRefreshWindow(ttl, options))
+
+
+def createTimeouts(options=option_defaults):
+    '''Return the Timeouts chosen in options, with any deadline counted from
+    now. Raises ValueError if an option is not valid.'''
+    budget = None
+    if options['deadline'] != None:
+        budget = float(options['deadline'])
+    timeouts = Timeouts(float(options['connect-timeout']), float(options['read-timeout']),
+                        budget)
+    if timeouts.connect <= 0 or timeouts.read <= 0 or (budget != None and budget <= 0):
+        raise ValueError("Timeouts must be more than 0 seconds")
+    return timeouts
+
+
+def circuitBreakerBackoff(options=option_defaults):
+    '''Return the longest backoff the circuit-breaker option allows, in
+    seconds, or None if it is not given. Raises ValueError if it is not
+    valid.'''
+    if not options['circuit-breaker']:
+        return None
+    if options['circuit-breaker'] == True:
+        return float(__max_backoff__)
+    max_backoff = float(options['circuit-breaker'])
+    if max_backoff <= 0:
+        raise ValueError("The circuit breaker backoff must be more than 0 seconds")
+    return max_backoff
+
+
+def raceStagger(options=option_defaults):
+    '''Return how long the race option waits between starting each URL, in
+    seconds, or None if it is not given. Raises ValueError if it is not
+    valid.'''
+    if options['race'] == None:
+        return None
+    if options['race'] == True:
+        return 0.0
+    stagger = float(options['race'])
+    if stagger < 0:
+        raise ValueError("The race stagger cannot be less than 0 seconds")
+    return stagger
+
+
+def watchWait(options=option_defaults):
+    '''Return how long the watch option asks servers to hold a request open,
+    in seconds, or None if it is not given. Raises ValueError if it is not
+    valid.'''
+    if options['watch'] == None:
+        return None
+    if options['watch'] == True:
+        return float(__watch_wait__)
+    wait = float(options['watch'])
+    if wait <= 0:
+        raise ValueError("The watch wait must be more than 0 seconds")
+    return wait
+
+
+def startMetrics(options, mode='config'):
+    '''Start the RunMetrics for this run, in mode, if the metrics option is
+    given.'''
+    global __metrics__
+    if options['metrics'] != None:
+        __metrics__ = RunMetrics(options['metrics'], mode)
+
+
+def saveMetrics(status):
+    '''Save the RunMetrics for this run, if there are any, with the exit
+    status. Failing to save them is logged but otherwise ignored.'''
+    global __metrics__
+    if __metrics__ == None:
+        return
+    try:
+        __metrics__.save(status)
+    except (IOError, os.error), e:
+        logging.error("Error saving metrics: %s" % e)
+    __metrics__ = None
+
+
+def summarizeMetrics(path, out_fp):
+    '''Write a summary of the RunMetrics records in the metrics file at path
+    to out_fp: the number of runs, how the configs were served and the
+    share served without going to a server, the 50th and 99th percentiles
+    of run length and lock wait, and the requests, errors and percentiles
+    of latency for each URL. Raises IOError if the file cannot be read.'''
+    import json
+
+    def percentiles(values):
+        '''Describe the 50th and 99th percentiles of values, by nearest rank.'''
+        values = sorted(values)
+        if len(values) == 0:
+            return 'p50 -  p99 -'
+        ranked = [values[max(0, (p * len(values) + 99) // 100 - 1)] for p in (50, 99)]
+        return 'p50 %.3f  p99 %.3f' % tuple(ranked)
+
+    records = []
+    fp = open(path, 'r')
+    try:
+        for line in fp:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.error("Skipping bad metrics record: %s" % line[:40])
+    finally:
+        fp.close()
+
+    served   = dict()
+    attempts = dict()
+    for record in records:
+        for source, count in record.get('served', dict()).items():
+            served[source] = served.get(source, 0) + count
+        for attempt in record.get('attempts', []):
+            attempts.setdefault(attempt['url'], []).append(attempt)
+    total = sum(served.values())
+    hits  = served.get('hit', 0) + served.get('daemon', 0)
+
+    out_fp.write('runs               %d\n' % len(records))
+    out_fp.write('served             %s\n' % ', '.join(['%s %d' % item for item in
+                                                      sorted(served.items())]))
+    if total > 0:
+        out_fp.write('hit ratio          %.3f\n' % (float(hits) / total))
+    out_fp.write('run seconds        %s\n' % percentiles([r['seconds'] for r in records
+                                                        if r.has_key('seconds')]))
+    out_fp.write('lock wait seconds  %s\n' % percentiles([r.get('lock_wait', 0.0)
+                                                        for r in records]))
+    out_fp.write('bytes received     %d\n' % sum([r.get('bytes', 0) for r in records]))
+    for url in sorted(attempts.keys()):
+        results = [attempt['result'] for attempt in attempts[url]]
+        out_fp.write('%s\n  requests %d  errors %d  not modified %d  seconds %s\n' %
+                     (url, len(results), results.count('error'), results.count('not_modified'),
+                      percentiles([attempt['seconds'] for attempt in attempts[url]])))
+
+
+def spawnBackgroundRefresh(argv):
+    '''Start a detached copy of this script that refreshes the cache named
+    on the command line argv and prints nothing. The copy does not inherit
+    our stdout, so HTCondor is not left waiting on the pipe for it.'''
+    import subprocess
+    if getattr(sys, 'frozen', False):
+        # py2exe build: the executable is the script
+        command = [sys.executable]
+    else:
+        command = [sys.executable, os.path.abspath(sys.argv[0])]
+    command = command + ['--refresh-only'] + argv
+
+    devnull = open(os.devnull, 'r+')
+    kwargs  = dict()
+    if os.name == 'nt':
+        # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        kwargs['creationflags'] = 0x00000008 | 0x00000200
+    else:
+        kwargs['close_fds']  = True
+        kwargs['preexec_fn'] = os.setsid
+    try:
+        subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, **kwargs)
+        logging.info("Started background refresh: %s" % " ".join(command))
+    finally:
+        devnull.close()
+
+
+def pendingFailure(cache_config_file, config_urls):
+    '''Return the record of the last failed refresh of cache_config_file from
+    config_urls, if it is not yet time to try them again. Otherwise None.
+    See CacheMetadata.failure().'''
+    metadata = CacheMetadata(cache_config_file.fileName)
+    failure  = metadata.failure(config_urls, cache_config_file.lastModified())
+    if failure != None and failure['retry_at'] > time.time():
+        return failure
+    return None
+
+
+def loadConfig(cache_config_file, config_urls, cache_lock_timeout, update=None,
+               options=option_defaults, opener=None):
+    '''Bring cache_config_file up to date for HTCondor: refresh it from
+    config_urls if update is True, or None and its TTL has expired, under
+    its DirectoryLock as options choose. When every URL fails, the failure
+    is recorded and the cache left as it is until the retry time. Returns
+    a header and the cache file to print after it, or None if there is
+    none. See writeConfig().'''
+    if opener == None:
+        opener = buildOpener(None, createTimeouts(options))
+    timeouts = opener.timeouts
+
+    # Only wait on the lock if the cache needs refreshing. Whoever held it
+    # was most likely refreshing the same cache, so check the TTL again once
+    # the lock is ours and reuse their copy rather than fetch another.
+    should_update = update
+    failure       = None
+    if should_update == None:
+        should_update = cache_config_file.shouldUpdate()
+        if should_update:
+            failure       = pendingFailure(cache_config_file, config_urls)
+            should_update = failure == None
+    if should_update:
+        try:
+            # Generate an app-specific directory name for our lock and then
+            # attempt to get a lock on it.
+            directoryName = cache_config_file.fileName + '_'
+            dlock         = DirectoryLock(directoryName)
+            lock_start    = time.time()
+            try:
+                dlock.acquire(True, timeouts.limit(cache_lock_timeout))
+            finally:
+                if __metrics__ != None:
+                    __metrics__.add('lock_wait', time.time() - lock_start)
+        except DirectoryLockError, error:
+            logging.error("Error acquiring directory lock: %s" % error)
+            pass
+        if update == None:
+            should_update = cache_config_file.shouldUpdate()
+            if should_update:
+                # Or whoever held it failed, just now.
+                failure       = pendingFailure(cache_config_file, config_urls)
+                should_update = failure == None
+
+    should_print   = False
+    error_occurred = failure != None
+    error_messages = []
+    header         = ''
+    # Whether any URL was tried. A deadline spent waiting on the lock is no
+    # failure of the URLs, so it is not recorded as one.
+    attempted      = False
+
+    # Once acquired, if cachefile doesn't exist or it is beyond its time to live (TTL),
+    # request the configuration file from the URL given. One the configuration has been
+    # fetched withou error, write it to temporary file and then move it in to place .
+    metadata = None
+    tier     = None
+    health   = None
+    urls     = config_urls
+    if should_update:
+        metadata = CacheMetadata(cache_config_file.fileName)
+        if options['tier'] != None:
+            tier = CacheTier(options['tier'], cache_config_file.fileTTL, cache_lock_timeout,
+                             options['compress-cache'])
+        max_backoff = circuitBreakerBackoff(options)
+        if max_backoff != None:
+            health = UrlHealth(cache_config_file.fileName, max_backoff)
+            config_urls, error_messages = health.arrange(config_urls)
+            if len(config_urls) == 0:
+                # Every URL is backed off, so the cache is used as it is.
+                error_occurred = True
+
+    stagger = raceStagger(options)
+    if should_update and stagger != None and len(config_urls) > 1:
+        attempted = not timeouts.expired()
+        try:
+            should_print, messages = raceConfig(cache_config_file, config_urls, stagger,
+                                                metadata, options, opener, tier, health)
+            error_occurred = not should_print
+            error_messages.extend(messages)
+        except Exception, e:
+            error_occurred = True
+            error_messages.append(str(e))
+            logging.error("Exception updating config: %s" % e)
+    elif should_update:
+        url_counter = 0
+        # Keep moving through the URLs in the list until we can pull a configuration
+        while should_print == False and url_counter < len(config_urls):       
+            try:
+                timeouts.check()
+            except DeadlineExceeded, e:
+                # Out of time: stop and fall back on the cached copy.
+                error_occurred = True
+                error_messages.append(str(e))
+                logging.error("Exception updating config: %s" % e)
+                break
+            attempted      = True
+            temp_file_name = None
+            try:
+                error_occurred     = False
+                temp_file_name     = cache_config_file.temporaryFileName()
+                logging.info("Opening temp cache file: %s" % temp_file_name)
+                temp_cache_file_fp = openCache(temp_file_name, 'w', options['compress-cache'])
+                try:
+                    logging.info("Opening URL #%d: %s" % \
+                            (url_counter+1, config_urls[url_counter]))
+                    validators = downloadConfig(config_urls[url_counter], \
+                            cache_config_file.fileName, temp_cache_file_fp, metadata,
+                            opener, tier, health)
+                finally:
+                    temp_cache_file_fp.close()
+                updateCache(cache_config_file, temp_file_name, validators, metadata,
+                            options['fsync'])
+                should_print = True
+            except Exception, e:
+                error_occurred = True
+                error_messages.append(str(e))
+                logging.error("Exception updating config: %s" % e)
+                removeFile(temp_file_name)
+            url_counter += 1
+
+    if health != None:
+        try:
+            health.save()
+        except (IOError, os.error), e:
+            logging.error("Error saving URL health: %s" % e)
+
+    # Every URL tried failed. Rewriting the cache with the error in it would
+    # restart its TTL and hide the failure, so the cache is left as it is
+    # and the failure is kept with its metadata, to be retried shortly.
+    if should_update and not should_print and attempted:
+        failure = metadata.failed(urls, cache_config_file.lastModified(), error_messages[-1],
+                                  min(__max_backoff__, cache_config_file.ttl()))
+        error_messages = error_messages[:-1]
+        try:
+            metadata.save()
+        except (IOError, os.error), e:
+            logging.error("Error saving cache metadata: %s" % e)
+
+    if len(error_messages) > 0:
+        header = 'CONFIG_FILE_ERROR = "Exception updating config: ' + "; ".join(error_messages) + '"\n\n'
+    if failure != None:
+        # The last error is added to the cached copy as it is printed.
+        header += 'CONFIG_FILE_ERROR="Exception updating config: %s"\n\n' % failure['error']
+    # If an error occurred updating the cache or we didn't need to update the
+    # cache file then read it. By not deleting the existing cache from disk before
+    # we've successfully cached the new version, it ensures we can always fall
+    # back on a stale, but correct configuration for the machine even if all
+    # of our config sources are offline.
+    if error_occurred or not should_update:
+        logging.info("Reusing the existing cached config file")
+        should_print = cache_config_file.exists()
+
+    if __metrics__ != None:
+        if not should_print:
+            __metrics__.served('failed')
+        elif update == False or error_occurred:
+            __metrics__.served('stale')
+        elif not should_update:
+            # Refreshed by whoever held the lock.
+            __metrics__.served('hit')
+        else:
+            __metrics__.served('refreshed')
+
+    if should_print:
+        return header, cache_config_file.fileName
+    return header, None
+
+
+def watchConfig(cache_config_file, url, lock_timeout, options, opener):
+    '''Ask url, with opener built to hold the request open (see
+    buildOpener()), for a newer config than cache_config_file's, and put it
+    in to effect as loadConfig() would, taking the lock only once it is in.
+    Returns True if the server held the request open. Raises the exception
+    of a failed request.'''
+    temp_file_name = cache_config_file.temporaryFileName()
+    try:
+        temp_cache_file_fp = openCache(temp_file_name, 'w', options['compress-cache'])
+        try:
+            validators = downloadConfig(url, cache_config_file.fileName, temp_cache_file_fp,
+                                        CacheMetadata(cache_config_file.fileName), opener)
+        finally:
+            temp_cache_file_fp.close()
+        dlock = DirectoryLock(cache_config_file.fileName + '_')
+        try:
+            try:
+                dlock.acquire(True, lock_timeout)
+            except DirectoryLockError, error:
+                logging.error("Error acquiring directory lock: %s" % error)
+            # Read the metadata again: it may have changed during the poll.
+            updateCache(cache_config_file, temp_file_name, validators,
+                        CacheMetadata(cache_config_file.fileName), options['fsync'])
+        finally:
+            if dlock.isLocked:
+                dlock.release()
+    except:
+        removeFile(temp_file_name)
+        raise
+    return opener.watcher.waited
+
+
+def refreshForever(cache_config_file, config_urls, lock_timeout, refresh, options):
+    '''Call refresh each time the TTL of cache_config_file runs out, or a
+    failed refresh is due a retry. With the watch option, each refresh waits
+    on watchConfig() for the first of config_urls, so a new config is put in
+    to effect as soon as its server has it. Never returns.'''
+    opener = None
+    wait   = watchWait(options)
+    if wait != None:
+        opener = buildOpener(None, Timeouts(float(options['connect-timeout']),
+                                            float(options['read-timeout']) + wait), wait)
+    watching = opener != None
+    while True:
+        if not watching:
+            cacheAge = cache_config_file.age()
+            if cacheAge == None:
+                cacheAge = cache_config_file.ttl()
+            pause   = cache_config_file.ttl() - cacheAge
+            failure = pendingFailure(cache_config_file, config_urls)
+            if failure != None:
+                pause = failure['retry_at'] - time.time()
+            time.sleep(max(1.0, pause))
+        watching = False
+        try:
+            if opener != None:
+                try:
+                    watching = watchConfig(cache_config_file, config_urls[0], lock_timeout,
+                                           options, opener)
+                except Exception, e:
+                    logging.error("Error watching %s: %s" % (config_urls[0], e))
+            refresh()
+        except Exception, e:
+            logging.error("Error refreshing %s: %s" % (cache_config_file.fileName, e))
+
+
+def readFromDaemon(socket_name, cache_file_name):
+    '''Ask a ConfigDaemon listening on socket_name for the config text of
+    cache_file_name. Returns the text, or None if no daemon answered.'''
+    import socket
+    try:
+        return readDaemon(socket_name, cache_file_name, __timeout__)
+    except socket.error, e:
+        logging.info("No daemon answering on %s: %s" % (socket_name, e))
+        return None
+
+
+def runDaemon(socket_name, cache_config_file, config_urls, lock_timeout, options):
+    '''Run a ConfigDaemon for cache_config_file in the foreground until it
+    is stopped. Returns the exit status for the process.'''
+    import socket
+    if not hasattr(socket, 'AF_UNIX'):
+        logging.error("Daemon mode needs Unix-domain sockets on this platform")
+        return 1
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    import signal
+    signal.signal(signal.SIGTERM, stop)
+
+    daemon = ConfigDaemon(socket_name, cache_config_file, config_urls, lock_timeout, options)
+    try:
+        daemon.listen()
+        daemon.serveForever()
+    except socket.error, e:
+        logging.error("Error running daemon: %s" % e)
+        return 1
+    finally:
+        daemon.close()
+        # A stop does not wait for the refresh thread, which may be in the
+        # middle of a long poll with its temp file open.
+        cache_config_file.removeTemporaryFiles()
+    return 0
+
+
+def tierOrigin(url, origins):
+    '''Return True if url starts with one of the origins prefixes. A
+    prefix naming only a server matches that server\'s URLs, not a server
+    whose name merely starts the same way.'''
+    for origin in origins:
+        if origin.count('/') < 3:
+            origin += '/'
+        if url.startswith(origin):
+            return True
+    return False
+
+
+def runTierServer(directory, address, origins, min_ttl, options):
+    '''Serve the CacheTier in directory over HTTP on address until the process
+    is stopped, answering /?url=URL&ttl=SECONDS for URLs under one of
+    origins with the tier's copy, refreshed if older than SECONDS or
+    min_ttl, or 502 if that fails. Returns the exit status for the process.'''
+    import BaseHTTPServer
+    import SocketServer
+    import socket
+    import urlparse
+
+    # Each request gets the timeouts but no deadline: the asking host
+    # keeps to its own.
+    opener = buildOpener(ConnectionPool(), Timeouts(float(options['connect-timeout']),
+                                                    float(options['read-timeout'])))
+
+    class TierRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        '''Answer cache tier requests from other hosts.'''
+
+        def do_GET(self):
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            url   = query.get('url', [''])[0]
+            if url.split(':')[0].lower() not in ('http', 'https'):
+                # Never hand out local files to other hosts.
+                self.send_error(400, "Only http and https URLs are served")
+                return
+            if not tierOrigin(url, origins):
+                # Nor act as an open proxy, filling the tier with whatever
+                # anyone asks for.
+                self.send_error(403, "The URL is not under a served origin")
+                return
+            try:
+                ttl = max(int(query.get('ttl', ['30'])[0]), min_ttl)
+            except ValueError:
+                self.send_error(400, "The ttl must be a number of seconds")
+                return
+
+            tier = CacheTier(directory, ttl, compress=options['compress-cache'])
+            try:
+                entry    = tier.refresh(url, opener)
+                cache_fp = openCache(entry.fileName)
+            except Exception, e:
+                logging.error("Error refreshing cache tier entry for %s: %s" % (url, e))
+                self.send_error(502, " ".join(str(e).split()))
+                return
+
+            values = CacheMetadata(entry.fileName).values
+            etag   = values.get('etag')
+            if etag and self.headers.getheader('If-None-Match') == etag:
+                cache_fp.close()
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            if etag:
+                self.send_header('ETag', etag)
+            if values.get('last_modified'):
+                self.send_header('Last-Modified', values.get('last_modified'))
+            self.end_headers()
+            writeToFile(cache_fp, self.wfile)
+
+        def log_message(self, format, *args):
+            logging.info("Cache tier request from %s: %s" % (self.client_address[0], format % args))
+
+    class TierServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads      = True
+        allow_reuse_address = True
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    import signal
+    signal.signal(signal.SIGTERM, stop)
+
+    if not os.path.isdir(directory):
+        logging.error("Cache tier directory not found: %s" % directory)
+        return 1
+    try:
+        server = TierServer(address, TierRequestHandler)
+    except socket.error, e:
+        logging.error("Error serving cache tier: %s" % e)
+        return 1
+    logging.info("Serving cache tier %s on %s port %d" % (directory, address[0] or "*",
+                                                          address[1]))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    return 0
+
+
+def readManifest(manifest_name, options=option_defaults):
+    '''Read a batch manifest, each line of which names one config as the
+    command line does: CACHE CACHE_TTL LOCK_TTL URL1 [URL2 ...]. Returns a
+    list of (CacheConfigFile, lock TTL, URL list) tuples. Raises IOError if
+    the manifest cannot be read and ValueError if a line is malformed.'''
+    entries = []
+    fp = open(manifest_name, 'r')
+    try:
+        line_number = 0
+        for line in fp:
+            line_number += 1
+            fields = line.split()
+            if len(fields) == 0 or fields[0].startswith('#'):
+                continue
+            try:
+                if len(fields) < 4:
+                    raise ValueError("expected CACHE CACHE_TTL LOCK_TTL URL1 [URL2 ...]")
+                entries.append((createCacheConfigFile(fields[0], int(fields[1]), options),
+                                int(fields[2]), fields[3:]))
+            except ValueError, e:
+                raise ValueError("%s line %d: %s" % (manifest_name, line_number, e))
+    finally:
+        fp.close()
+    return entries
+
+
+def refreshEntries(entries, worker_count, options):
+    '''Bring every config in entries, a list of (CacheConfigFile, lock TTL,
+    URL list) tuples, up to date. Expired caches are refreshed worker_count
+    at a time, sharing one ConnectionPool, so each server is connected to
+    once rather than once per config. Returns the header and cache file
+    name to print for each entry, in order, as loadConfig() does.'''
+    # A config that needs no refresh is printed from its cache as it is.
+    results = [('', entry[0].fileName) for entry in entries]
+    expired = [i for i in range(len(entries)) if entries[i][0].shouldUpdate()]
+    if __metrics__ != None:
+        for index in range(len(entries) - len(expired)):
+            __metrics__.served('hit')
+    if len(expired) > 0:
+        import threading
+        import Queue
+        setupNetwork(options)
+        pool = ConnectionPool()
+        timeouts = createTimeouts(options)
+        work = Queue.Queue()
+        for index in expired:
+            work.put(index)
+
+        def refresh():
+            opener = buildOpener(pool, timeouts)
+            while True:
+                try:
+                    index = work.get(False)
+                except Queue.Empty:
+                    return
+                cache_config_file, lock_timeout, config_urls = entries[index]
+                try:
+                    results[index] = loadConfig(cache_config_file, config_urls, lock_timeout,
+                                                None, options, opener)
+                except Exception, e:
+                    logging.error("Error refreshing %s: %s" % (cache_config_file.fileName, e))
+
+        workers = [threading.Thread(target=refresh)
+                   for i in range(max(1, min(worker_count, len(expired))))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        pool.close()
+        logging.info("Refreshed %d configs over %d connections" % (len(expired), pool.opened))
+    return results
+
+
+def layerEntries(cache_file_name, cache_ttl, lock_timeout, config_urls,
+                 options=option_defaults):
+    '''Return the layers of a layered config as entries for refreshEntries():
+    each of config_urls is a layer, cached in cache_file_name with .layerN
+    appended, counting from 1, under the TTL given for it in the layers
+    option, or cache_ttl. Raises ValueError if the option is not valid.'''
+    ttls = [cache_ttl] * len(config_urls)
+    if options['layers'] != True:
+        ttls = [int(ttl) for ttl in options['layers'].split(',')]
+        if len(ttls) != len(config_urls):
+            raise ValueError("--layers needs one TTL for each URL")
+    entries = []
+    for index in range(len(config_urls)):
+        cache_config_file = createCacheConfigFile('%s.layer%d' % (cache_file_name, index + 1),
+                                                  ttls[index], options)
+        entries.append((cache_config_file, lock_timeout, [config_urls[index]]))
+    return entries
+
+
+def runLayers(entries, options):
+    '''Bring every layer of a layered config, in entries from
+    layerEntries(), up to date at once, as refreshEntries() does, and print
+    them in order as one config. HTCondor takes the last setting of a
+    macro, so later layers win. Each layer falls back on its own cache, as
+    loadConfig() does. Returns the exit status for the process.'''
+    results = refreshEntries(entries, len(entries), options)
+    if options['refresh-only']:
+        return 0
+    for header, file_name in results:
+        writeConfig(header, file_name, sys.stdout)
+    return 0
+
+
+def runBatch(manifest_name, worker_count, options):
+    '''Bring every config in the batch manifest up to date, as
+    refreshEntries() does, and print them in the order they are listed, as
+    HTCondor would read them one after another. With the watch option, the
+    process then stays resident, keeping every config up to date with
+    refreshForever(). Returns the exit status for the process.'''
+    try:
+        entries = readManifest(manifest_name, options)
+    except (IOError, ValueError), e:
+        logging.error("Error reading batch manifest: %s" % e)
+        return 1
+
+    results = refreshEntries(entries, worker_count, options)
+    if options['refresh-only']:
+        return 0
+    for header, file_name in results:
+        writeConfig(header, file_name, sys.stdout)
+    if options['watch'] == None:
+        return 0
+
+    # Stay resident, keeping every config up to date as refreshForever()
+    # schedules it, until the process is stopped. The metrics record covers
+    # the batch itself.
+    import signal
+    import threading
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    sys.stdout.flush()
+    saveMetrics(0)
+    setupNetwork(options)
+    for entry in entries:
+        cache_config_file, lock_timeout, config_urls = entry
+        refresh = lambda entry=entry: loadConfig(entry[0], entry[2], entry[1], None, options)
+        watcher = threading.Thread(target=refreshForever,
+                                   args=(cache_config_file, config_urls, lock_timeout,
+                                         refresh, options))
+        watcher.setDaemon(True)
+        watcher.start()
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        for entry in entries:
+            entry[0].removeTemporaryFiles()
+
+
+def main(early_draw=None):
+    '''The main() routine that drives the script. early_draw is the draw
+    cache_config.serveHit() already made for an early refresh, if any.'''
+    setupLogging()
+    try:
+        options, arguments = parseOptions(sys.argv[1:])
+    except ValueError, e:
+        logging.error("Error parsing options: %s" % e)
+        return 1
+
+    for name in ['batch', 'tier', 'serve-tier', 'tier-bind', 'tier-origins', 'query',
+                 'metrics', 'metrics-summary', 'dns-cache']:
+        if options[name] == True:
+            logging.error("Error parsing options: --%s needs a value" % name)
+            return 1
+
+    try:
+        createTimeouts(options)
+    except (TypeError, ValueError):
+        logging.error("Error parsing options: timeouts need a number of seconds")
+        return 1
+
+    try:
+        float(options['dns-ttl'])
+    except (TypeError, ValueError):
+        logging.error("Error parsing options: --dns-ttl needs a number of seconds")
+        return 1
+
+    try:
+        circuitBreakerBackoff(options)
+    except (TypeError, ValueError):
+        logging.error("Error parsing options: --circuit-breaker needs a number of seconds")
+        return 1
+
+    try:
+        raceStagger(options)
+    except (TypeError, ValueError):
+        logging.error("Error parsing options: --race needs a number of seconds")
+        return 1
+
+    try:
+        watch = watchWait(options)
+    except ValueError:
+        logging.error("Error parsing options: --watch needs a number of seconds")
+        return 1
+    if watch != None and not options['daemon'] and options['batch'] == None:
+        logging.error("Error parsing options: --watch needs --daemon or --batch")
+        return 1
+
+    if options['metrics-summary'] != None:
+        try:
+            summarizeMetrics(options['metrics-summary'], sys.stdout)
+        except IOError, e:
+            logging.error("Error reading metrics: %s" % e)
+            return 1
+        return 0
+
+    if options['serve-tier'] != None:
+        try:
+            port = int(options['tier-port'])
+        except ValueError:
+            logging.error("Error parsing options: --tier-port needs a number")
+            return 1
+        try:
+            min_ttl = int(options['tier-min-ttl'])
+        except ValueError:
+            logging.error("Error parsing options: --tier-min-ttl needs a number of seconds")
+            return 1
+        if options['tier-origins'] == None:
+            logging.error("Error parsing options: --serve-tier needs --tier-origins")
+            return 1
+        origins = [origin for origin in options['tier-origins'].split(',') if origin]
+        setupNetwork(options)
+        return runTierServer(options['serve-tier'], (options['tier-bind'], port), origins,
+                             min_ttl, options)
+
+    if options['batch'] != None:
+        try:
+            worker_count = int(options['batch-workers'])
+        except ValueError:
+            logging.error("Error parsing options: --batch-workers needs a number")
+            return 1
+        startMetrics(options, 'batch')
+        return runBatch(options['batch'], worker_count, options)
+
+    if len(arguments) > 3:
+        try:
+            logging.info("Parsing Arguments...")
+            cache_file_name    = arguments[0]
+            cache_file_timeout = int(arguments[1])
+            cache_lock_timeout = int(arguments[2])
+            cache_config_file  = createCacheConfigFile(cache_file_name, cache_file_timeout,
+                                                       options)
+            cache_config_file.earlyDraw = early_draw
+            config_urls        = arguments[3:]
+            max_stale          = cache_file_timeout
+            if options['max-stale'] != None:
+                max_stale = int(options['max-stale'])
+            logging.debug("CacheFile Name: %s\nCacheFile TTL: %d\nLock TTL: %d\n" % \
+                    (cache_file_name, cache_file_timeout, cache_lock_timeout))
+            for u in config_urls:
+                logging.debug("Config URL: %s" %u)
+        except:
+            logging.error("Error parsing arguments...")
+            return 1
+
+        if options['layers'] != None:
+            # The layers are printed as one merged config, with no single
+            # cache file for these to work on.
+            for name in ['daemon', 'use-daemon', 'socket', 'stale-while-revalidate',
+                         'max-stale', 'digest', 'query']:
+                if options[name] != option_defaults[name]:
+                    logging.error("Error parsing options: --layers cannot be used with --%s"
+                                  % name)
+                    return 1
+            try:
+                entries = layerEntries(cache_file_name, cache_file_timeout, cache_lock_timeout,
+                                       config_urls, options)
+            except ValueError, e:
+                logging.error("Error parsing options: %s" % e)
+                return 1
+            startMetrics(options, 'layers')
+            return runLayers(entries, options)
+
+        # Generate an app-specific directory name for our lock.
+        directoryName = cache_config_file.fileName + '_'
+        refresh_only  = options['refresh-only']
+        socket_name   = options['socket']
+        if socket_name == None:
+            socket_name = cache_config_file.fileName + '.sock'
+
+        if options['daemon']:
+            setupNetwork(options)
+            return runDaemon(socket_name, cache_config_file, config_urls, cache_lock_timeout,
+                             options)
+
+        startMetrics(options)
+        if __metrics__ != None:
+            __metrics__.update({ 'cache'     : cache_config_file.fileName,
+                                 'cache_age' : cache_config_file.age() })
+
+        # A running daemon already holds the config in memory. If none is
+        # answering, carry on and read the cache file directly.
+        if options['use-daemon'] and not refresh_only and not options['digest'] and \
+                options['query'] == None:
+            output = readFromDaemon(socket_name, cache_config_file.fileName)
+            if output:
+                if __metrics__ != None:
+                    __metrics__.served('daemon')
+                sys.stdout.write(output)
+                return 0
+
+        # The fast path: a cache hit prints the cache file and is done,
+        # without setting up the network or the lock.
+        if not cache_config_file.shouldUpdate():
+            if __metrics__ != None:
+                __metrics__.served('hit')
+            if options['digest']:
+                writeDigest(cache_config_file.fileName, sys.stdout)
+            elif options['query'] != None:
+                writeQuery('', cache_config_file.fileName, options['query'].split(','),
+                           sys.stdout)
+            elif not refresh_only:
+                writeConfig('', cache_config_file.fileName, sys.stdout)
+            return 0
+
+        setupNetwork(options)
+
+        # In stale-while-revalidate mode an expired, but not too stale, cache
+        # is served straight away without waiting on the lock or the network.
+        # A detached copy of this script refreshes it for the next caller,
+        # unless the lock shows a refresh is already under way, or the last
+        # one failed and it is not yet time to try again.
+        serve_stale = False
+        if options['stale-while-revalidate'] and not refresh_only and \
+                cache_config_file.canServeStale(max_stale) and \
+                pendingFailure(cache_config_file, config_urls) == None:
+            serve_stale = True
+            if not DirectoryLock(directoryName).isBusy():
+                try:
+                    spawnBackgroundRefresh(sys.argv[1:])
+                except Exception, e:
+                    logging.error("Error starting background refresh: %s" % e)
+
+        # SWR: serve the cache as it is; otherwise the TTL decides, so a
+        # background refresh that finds the cache already refreshed by
+        # someone else leaves it be.
+        update = None
+        if serve_stale:
+            update = False
+        header, file_name = loadConfig(cache_config_file, config_urls, cache_lock_timeout,
+                                       update, options)
+
+        if refresh_only:
+            # A background refresh has no one to print the config for.
+            return 0
+
+        if should_log:
+            # If we are logging, give the user a chance to read the output.
+            time.sleep(5)
+
+        if options['digest']:
+            writeDigest(file_name, sys.stdout)
+        elif options['query'] != None:
+            writeQuery(header, file_name, options['query'].split(','), sys.stdout)
+        else:
+            writeConfig(header, file_name, sys.stdout)
+    else:
+        # Print out usage information, but do it in the form of valid Condor
+        # configuration syntax so Condor isn't crashed by incorrect use of
+        # this tool.
+        print 'APPLICATION = "cache_config v%s"' % __version__
+        print 'ARGUMENTS = "cache_config [OPTIONS] CACHE CACHE_TTL LOCK_TTL URL1 [URL2 ...]"'
+        print 'OPTIONS = "--stale-while-revalidate --max-stale=SECONDS --daemon --use-daemon --socket=PATH --race[=SECONDS] --fsync --compress-cache --batch=MANIFEST --batch-workers=N --tier=LOCATION --serve-tier=DIRECTORY --tier-port=PORT --tier-bind=ADDRESS --tier-origins=PREFIX[,PREFIX...] --tier-min-ttl=SECONDS --ttl-jitter=FRACTION --early-refresh[=SECONDS] --circuit-breaker[=SECONDS] --connect-timeout=SECONDS --read-timeout=SECONDS --deadline=SECONDS --digest --query=NAME[,NAME...] --metrics=PATH --metrics-summary=PATH --watch[=SECONDS] --layers[=TTL1,TTL2...] --dns-cache=PATH --dns-ttl=SECONDS"'
+        print 'CACHE_CONFIG_COPYRIGHT = "Cycle Computing, LLC 2007 -"'
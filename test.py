@@ -43,7 +43,14 @@ import os
 import sys
 import time
 import subprocess
+import socket
 import re
+import shutil
+import hashlib
+import json
+import urlparse
+import urllib
+import urllib2
 
 
 ################################################################################
@@ -99,10 +106,12 @@ def runTest(site, test, defaultCache, **kwArgs):
     args = kwArgs.copy()
     if not args.has_key("fallback"):
         args["fallback"] = ""
+    if not args.has_key("options"):
+        args["options"] = ""
     args["site"] = site
     args["test"] = test
 
-    result = run("python cache_config.py cache_file 30 30 %(site)s/%(test)s %(fallback)s" % args)
+    result = run("python cache_config.py %(options)s cache_file 30 30 %(site)s/%(test)s %(fallback)s" % args)
 
     return result
 
@@ -117,6 +126,13 @@ def runTests(site):
     # success case (no initial cache)
     result = runTest(site, "success", None)
     assertEquals("Success\nLine2", result, "200 case")
+
+    # cache hit case, the unexpired cache is printed without contacting the URL,
+    # with or without options that only matter to a refresh
+    result = run("python cache_config.py cache_file 30 30 %s/error" % site)
+    assertEquals("Success\nLine2", result, "cache hit case")
+    result = run("python cache_config.py --stale-while-revalidate --race cache_file 30 30 %s/error" % site)
+    assertEquals("Success\nLine2", result, "cache hit case (refresh options)")
                  
     # server error case (no initial cache)
     result = runTest(site, "error_nocache", None)
@@ -148,6 +164,11 @@ def runTests(site):
     assertEquals('CONFIG_FILE_ERROR="Exception updating config: HTTP Error 500: Internal Server Error"\n\nError Cached copy', 
                  result, "500 case")
 
+    # server error case, an error embedded in a cache by an older version is replaced
+    result = runTest(site, "error_cache", 'CONFIG_FILE_ERROR="Exception updating config: old"\n\nError Cached copy')
+    assertEquals('CONFIG_FILE_ERROR="Exception updating config: HTTP Error 500: Internal Server Error"\n\nError Cached copy', 
+                 result, "500 case (older cache)")
+
     # auth requested case
     result = runTest(site, "auth", 'Auth Cached copy')
     assertEquals('CONFIG_FILE_ERROR="Exception updating config: HTTP Error 401: Unauthorized"\n\nAuth Cached copy', 
@@ -161,6 +182,345 @@ def runTests(site):
     result = runTest(site, "not_modified/stale", '304 Cached copy')
     assertEquals('Downloaded copy', result, "not-modified case (download)")
 
+    # stale-while-revalidate case, stale cache served while it refreshes in the background
+    startTime = time.time()
+    result = runTest(site, "success", 'SWR Cached copy',
+                     options="--stale-while-revalidate --max-stale=120")
+    runTime = time.time() - startTime
+    assertEquals('SWR Cached copy', result, "stale-while-revalidate case (serve stale)")
+    if runTime > 1:
+        raise TestError("Stale cache should have been served at once; took %s sec" % (runTime))
+    time.sleep(2)
+    fp = open("cache_file", "rU")
+    result = fp.read()
+    fp.close()
+    assertEquals('Success\nLine2', result, "stale-while-revalidate case (background refresh)")
+
+    # stale-while-revalidate case, cache too stale to serve so fetched at once
+    result = runTest(site, "success", 'SWR Cached copy',
+                     options="--stale-while-revalidate --max-stale=10")
+    assertEquals('Success\nLine2', result, "stale-while-revalidate case (max stale)")
+
+    # jittered TTL and early refresh case, an expired cache is still refreshed
+    result = runTest(site, "success", 'Jitter Cached copy', options="--ttl-jitter=0.2 --early-refresh")
+    assertEquals('Success\nLine2', result, "jitter case")
+
+    # digest case, the same config sent again only restarts the cache's TTL
+    result = runTest(site, "success", None, options="--digest")
+    assertEquals(hashlib.sha1("Success\nLine2").hexdigest(), result, "digest case")
+    modtime = time.time() - 60
+    os.utime("cache_file", (modtime, modtime))
+    inode = os.stat("cache_file").st_ino
+    result = run("python cache_config.py --digest cache_file 30 30 %s/success" % site)
+    assertEquals(hashlib.sha1("Success\nLine2").hexdigest(), result, "digest case (unchanged)")
+    if os.stat("cache_file").st_ino != inode or os.path.getmtime("cache_file") < time.time() - 30:
+        raise TestError("Unchanged config should only have had its cache file touched")
+
+    # digest case, a config with CRLF line endings is recognized as unchanged too
+    result = runTest(site, "crlf", None, options="--digest")
+    assertEquals(hashlib.sha1("Crlf\r\nLine2\r\n").hexdigest(), result, "digest case (CRLF)")
+    modtime = time.time() - 60
+    os.utime("cache_file", (modtime, modtime))
+    inode = os.stat("cache_file").st_ino
+    result = run("python cache_config.py --digest cache_file 30 30 %s/crlf" % site)
+    assertEquals(hashlib.sha1("Crlf\r\nLine2\r\n").hexdigest(), result, "digest case (CRLF, unchanged)")
+    if os.stat("cache_file").st_ino != inode or os.path.getmtime("cache_file") < time.time() - 30:
+        raise TestError("Unchanged CRLF config should only have had its cache file touched")
+
+    # compression case, each Content-Encoding is undone as the config is cached
+    for encoding in ["gzip", "deflate", "raw"]:
+        result = runTest(site, "compressed/" + encoding, None)
+        assertEquals('Compressed\nLine2', result, "compression case (%s)" % encoding)
+        fp = open("cache_file", "rb")
+        cached = fp.read()
+        fp.close()
+        assertEquals('Compressed\nLine2', cached, "compression case (%s, cache file)" % encoding)
+
+    # compression case, a compressed response that is cut off keeps the cached copy
+    for encoding in ["gzip", "deflate", "raw"]:
+        result = runTest(site, "truncated/" + encoding, 'Truncated Cached copy')
+        name = encoding
+        if encoding == "raw":
+            name = "deflate"
+        assertEquals('CONFIG_FILE_ERROR="Exception updating config: %s response ended before the end of its compressed data"\n\nTruncated Cached copy' % name,
+                     result, "compression case (%s, truncated)" % encoding)
+
+    # compression case, --compress-cache keeps the cache gzipped and reads it back
+    for encoding in ["gzip", "deflate", "raw"]:
+        result = runTest(site, "compressed/" + encoding, None, options="--compress-cache")
+        assertEquals('Compressed\nLine2', result, "compressed cache case (%s)" % encoding)
+        fp = open("cache_file", "rb")
+        magic = fp.read(2)
+        fp.close()
+        if magic != "\x1f\x8b":
+            raise TestError("compressed cache case (%s): cache file is not gzipped" % encoding)
+        result = run("python cache_config.py --compress-cache cache_file 30 30 %s/error" % site)
+        assertEquals('Compressed\nLine2', result, "compressed cache case (%s, cached)" % encoding)
+
+    # query case, macros looked up in the index of the cached config
+    opened_files["cache_file.index"] = True
+    result = runTest(site, "error", 'A = 1\nLong = two \\\n  lines\n\nA = 2\n',
+                     options="--query=long,a,missing,CONFIG_FILE_ERROR")
+    assertEquals('Long = two   lines\nA = 2\nCONFIG_FILE_ERROR = "Exception updating config: HTTP Error 500: Internal Server Error"',
+                 result, "query case")
+    os.remove("cache_file.index")
+
+    # query case, a cache rewritten in place at the same size is indexed again
+    fp = open("cache_file", "w")
+    fp.write("A = 1\n")
+    fp.close()
+    os.utime("cache_file", (time.time() - 5, time.time() - 5))
+    result = run("python cache_config.py --query=a cache_file 30 30 %s/success" % site)
+    assertEquals('A = 1', result, "query case (before rewrite)")
+    fp = open("cache_file", "r+")
+    fp.write("A = 2\n")
+    fp.close()
+    result = run("python cache_config.py --query=a cache_file 30 30 %s/success" % site)
+    assertEquals('A = 2', result, "query case (rewritten in place)")
+    os.remove("cache_file.index")
+
+    # metrics case, each run appends a record that the summary counts
+    opened_files["metrics_file"] = True
+    if os.path.exists("metrics_file"):
+        os.remove("metrics_file")
+    runTest(site, "success", None, options="--metrics=metrics_file")
+    run("python cache_config.py --metrics=metrics_file cache_file 30 30 %s/success" % site)
+    result = run("python cache_config.py --metrics-summary=metrics_file")
+    if not re.search(r"^runs +2$", result, re.M) or \
+       not re.search(r"^served +hit 1, refreshed 1$", result, re.M):
+        raise TestError("metrics case: Expected 2 runs, one a cache hit, but got\n" + result)
+
+    # delta case, only the changes to the cached copy are fetched and applied
+    result = runTest(site, "delta/old", None)
+    assertEquals('A = 1\nB = 2\nC = 3\nD = 4', result, "delta case (full)")
+    modtime = time.time() - 60
+    os.utime("cache_file", (modtime, modtime))
+    result = run("python cache_config.py cache_file 30 30 %s/delta/new" % site)
+    assertEquals('A = 1\nB = two\nD = 4\nE = 5', result, "delta case (applied)")
+
+    # delta case, a delta that does not apply to the cached copy falls back on the whole config
+    result = runTest(site, "delta/old", None)
+    fp = open("cache_file", "w")
+    fp.write("Changed on disk\n")
+    fp.close()
+    os.utime("cache_file", (modtime, modtime))
+    result = run("python cache_config.py cache_file 30 30 %s/delta/new" % site)
+    assertEquals('A = 1\nB = two\nD = 4\nE = 5', result, "delta case (fallback)")
+
+    # delta case, a config with CRLF line endings is patched without a refetch
+    result = runTest(site, "delta/crlf-old", None)
+    os.utime("cache_file", (modtime, modtime))
+    result = run("python cache_config.py cache_file 30 30 %s/delta/crlf-new" % site)
+    assertEquals('A = 1\nB = two\nD = 4\nE = 5', result, "delta case (CRLF)")
+    fp = open("cache_file", "rb")
+    result = fp.read()
+    fp.close()
+    if result != "A = 1\r\nB = two\r\nD = 4\r\nE = 5\r\n":
+        raise TestError("delta case (CRLF): Expected the CRLF line endings kept but got\n" + repr(result))
+
+    # circuit breaker case, a URL that just failed is skipped on the next refresh
+    opened_files["cache_file.health"] = True
+    if os.path.exists("cache_file.health"):
+        os.remove("cache_file.health")
+    result = runTest(site, "error", None, fallback=site + "/success", options="--circuit-breaker")
+    assertEquals('CONFIG_FILE_ERROR = "Exception updating config: HTTP Error 500: Internal Server Error"\n\nSuccess\nLine2', 
+                 result, "circuit breaker case (failure)")
+    result = runTest(site, "error", None, fallback=site + "/success", options="--circuit-breaker")
+    assertEquals('CONFIG_FILE_ERROR = "Exception updating config: HTTP Error 500: Internal Server Error (skipped until XX:XX:XX)"\n\nSuccess\nLine2', 
+                 re.sub(r'\d\d:\d\d:\d\d', 'XX:XX:XX', result), "circuit breaker case (skipped)")
+    # circuit breaker case, a URL whose backoff has run out is tried again in its place
+    fp = open("cache_file.health", "w")
+    json.dump({ site + "/success" : { "failures" : 1, "error" : "HTTP Error 500",
+                                      "retry_at" : time.time() - 1 } }, fp)
+    fp.close()
+    result = runTest(site, "success", None, fallback=site + "/error", options="--circuit-breaker")
+    assertEquals('Success\nLine2', result, "circuit breaker case (retried)")
+    fp = open("cache_file.health")
+    record = json.load(fp)[site + "/success"]
+    fp.close()
+    if record.get("failures"):
+        raise TestError("circuit breaker case (retried): the retried URL should be healthy again")
+    if record.get("latency") == None:
+        raise TestError("circuit breaker case (retried): the URL's response time should be recorded")
+
+    # race case, black-holed first URL does not delay the fallback URL that works
+    startTime = time.time()
+    result = runTest(site, "timeout", None, fallback=site + "/success", options="--race")
+    runTime = time.time() - startTime
+    assertEquals('Success\nLine2', result, "race case")
+    if runTime > 2:
+        raise TestError("Race should not have waited on the timeout URL; took %s sec" % (runTime))
+
+    # race case, every URL fails so the cached copy is reused
+    result = runTest(site, "error", 'Race Cached copy', fallback=site + "/auth", options="--race")
+    assertEquals('CONFIG_FILE_ERROR = "Exception updating config: HTTP Error 500: Internal Server Error"\n\nCONFIG_FILE_ERROR="Exception updating config: HTTP Error 401: Unauthorized"\n\nRace Cached copy', 
+                 result, "race case (all fail)")
+
+    # deadline case, a slow URL uses up the deadline so the cached copy is used
+    startTime = time.time()
+    result = runTest(site, "timeout", 'Deadline Cached copy', fallback=site + "/success",
+                     options="--deadline=1")
+    runTime = time.time() - startTime
+    if runTime > 2:
+        raise TestError("Waited %s sec for response; expected the 1 sec deadline" % (runTime))
+    if not result.startswith('CONFIG_FILE_ERROR = "Exception updating config: ') or \
+       not result.endswith('"\n\nCONFIG_FILE_ERROR="Exception updating config: deadline of 1 seconds passed"\n\nDeadline Cached copy'):
+        raise TestError("deadline case: Expected the cached copy but got\n" + result)
+
+    # deadline case, a URL that trickles its response a byte at a time is cut off too
+    startTime = time.time()
+    result = runTest(site, "drip", 'Drip Cached copy', options="--deadline=2 --read-timeout=1")
+    runTime = time.time() - startTime
+    if runTime > 3:
+        raise TestError("Waited %s sec for response; expected the 2 sec deadline" % (runTime))
+    if not result.endswith('CONFIG_FILE_ERROR="Exception updating config: deadline of 2 seconds passed"\n\nDrip Cached copy'):
+        raise TestError("deadline case (drip): Expected the cached copy but got\n" + result)
+
+    # deadline case, a deadline spent waiting on another run's lock is not
+    # recorded as a failure of the URL, so the next run refreshes at once
+    # (Windows locks with a directory rather than flock())
+    if os.name != 'nt':
+        import fcntl
+        opened_files["cache_file.meta"] = True
+        if os.path.exists("cache_file.meta"):
+            os.remove("cache_file.meta")
+        lock_fd = os.open("cache_file_.lock", os.O_RDWR | os.O_CREAT)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        try:
+            result = runTest(site, "success", 'Lock Cached copy', options="--deadline=1")
+        finally:
+            os.close(lock_fd)
+        assertEquals('CONFIG_FILE_ERROR = "Exception updating config: deadline of 1 seconds passed"\n\nLock Cached copy',
+                     result, "deadline case (lock)")
+        result = run("python cache_config.py cache_file 30 30 %s/success" % site)
+        assertEquals("Success\nLine2", result, "deadline case (lock, next run)")
+
+    # deadline case, a large body on a connection the server closes is read in full
+    result = runTest(site, "large", None, options="--deadline=10")
+    assertEquals("Large = " + "x" * 100000, result, "deadline case (large)")
+
+    # layers case, each URL a layer of one config with its own cache, later layers last
+    for name in ["cache_file.layer1", "cache_file.layer2"]:
+        opened_files[name] = True
+        if os.path.exists(name):
+            os.remove(name)
+    fp = open("cache_file.layer2", "w")
+    fp.write("Layer Cached copy")
+    fp.close()
+    modtime = time.time() - 60
+    os.utime("cache_file.layer2", (modtime, modtime))
+    result = run("python cache_config.py --layers=30,10 cache_file 30 30 %s/success %s/error"
+                 % (site, site))
+    assertEquals('Success\nLine2\nCONFIG_FILE_ERROR="Exception updating config: HTTP Error 500: Internal Server Error"\n\nLayer Cached copy', 
+                 result, "layers case")
+
+    # layers case, options that work on a single cache file are refused
+    devnull = open(os.devnull, "w")
+    for option in ["--query=A", "--digest", "--daemon", "--stale-while-revalidate"]:
+        status = subprocess.call(["python", "cache_config.py", "--layers", option, "cache_file",
+                                  "30", "30", site + "/success"], stdout=devnull, stderr=devnull)
+        if status != 1:
+            raise TestError("layers case (%s): Expected exit status 1 but got %d" % (option, status))
+    devnull.close()
+
+    # dns cache case, a host the resolver does not know is reached at its old cached address
+    opened_files["dns_file"] = True
+    url  = urlparse.urlsplit(site)
+    port = url.port or 80
+    fp = open("dns_file", "w")
+    json.dump({ "cache-config-test.invalid:%d" % port :
+                { "addresses" : socket.getaddrinfo(url.hostname, port, 0, socket.SOCK_STREAM),
+                  "resolved"  : 0 } }, fp)
+    fp.close()
+    result = runTest("%s://cache-config-test.invalid:%d%s" % (url.scheme, port, url.path),
+                     "success", None, options="--dns-cache=dns_file")
+    assertEquals('Success\nLine2', result, "dns cache case")
+
+    # batch case, every config in the manifest refreshed and printed in order
+    opened_files["batch_manifest"] = True
+    for name in ["batch_cache_1", "batch_cache_2"]:
+        opened_files[name] = True
+        if os.path.exists(name):
+            os.remove(name)
+    fp = open("batch_manifest", "w")
+    fp.write("# CACHE CACHE_TTL LOCK_TTL URL1 [URL2 ...]\n")
+    fp.write("batch_cache_1 30 30 %s/success\n\n" % site)
+    fp.write("batch_cache_2 30 30 %s/error %s/not_modified/stale\n" % (site, site))
+    fp.close()
+    result = run("python cache_config.py --batch=batch_manifest")
+    assertEquals('Success\nLine2\nCONFIG_FILE_ERROR = "Exception updating config: HTTP Error 500: Internal Server Error"\n\nDownloaded copy', 
+                 result, "batch case")
+
+    # cache tier case, the tier's fresh copy is used in place of the URL itself
+    opened_files["cache_tier"] = True
+    if not os.path.isdir("cache_tier"):
+        os.mkdir("cache_tier")
+    fp = open(os.path.join("cache_tier", hashlib.sha1(site + "/error").hexdigest()), "w")
+    fp.write("Tier copy")
+    fp.close()
+    result = runTest(site, "error", None, options="--tier=cache_tier")
+    assertEquals('Tier copy', result, "cache tier case (directory)")
+
+    # cache tier case, the same tier served to other hosts by a peer
+    tier_server = subprocess.Popen(["python", "cache_config.py", "--serve-tier=cache_tier",
+                                    "--tier-port=18642", "--tier-origins=" + site])
+    try:
+        time.sleep(2)
+        result = runTest(site, "error", None, options="--tier=http://localhost:18642/")
+        assertEquals('Tier copy', result, "cache tier case (peer)")
+        # ...but only for URLs under one of its origins
+        try:
+            urllib2.urlopen("http://localhost:18642/?url=" + urllib.quote("http://elsewhere/", ""))
+            result = "200"
+        except urllib2.HTTPError, e:
+            result = str(e.code)
+        assertEquals("403", result, "cache tier case (peer, other origin)")
+    finally:
+        tier_server.terminate()
+        tier_server.wait()
+
+    # cache tier case, a missing tier is passed over for the URL itself
+    result = runTest(site, "success", None, options="--tier=no_such_tier")
+    assertEquals('Success\nLine2', result, "cache tier case (no tier)")
+
+    # daemon client case, no daemon running so the cache file is used directly
+    result = runTest(site, "success", None, options="--use-daemon")
+    assertEquals('Success\nLine2', result, "daemon case (no daemon)")
+
+    # daemon client case, config served from the daemon's memory
+    if hasattr(socket, "AF_UNIX"):
+        opened_files["cache_file.sock"] = True
+        daemon = subprocess.Popen(["python", "cache_config.py", "--daemon",
+                                   "cache_file", "30", "30", site + "/success"])
+        try:
+            time.sleep(2)
+            fp = open("cache_file", "w")
+            fp.write("Changed on disk")
+            fp.close()
+            result = run("python cache_config.py --use-daemon cache_file 30 30 %s/success" % site)
+            assertEquals('Success\nLine2', result, "daemon case (in memory)")
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+        # watch case, the daemon picks up a new version well within the TTL
+        if os.path.exists("cache_file"):
+            os.remove("cache_file")
+        daemon = subprocess.Popen(["python", "cache_config.py", "--daemon", "--watch=10",
+                                   "cache_file", "30", "30", site + "/watch/2"])
+        try:
+            time.sleep(1)
+            first = run("python cache_config.py --use-daemon cache_file 30 30 %s/watch/2" % site)
+            time.sleep(3)
+            second = run("python cache_config.py --use-daemon cache_file 30 30 %s/watch/2" % site)
+            if not first.startswith("Version ") or not second.startswith("Version ") or \
+               second == first:
+                raise TestError("watch case: Expected a new version but got\n%s\nthen\n%s"
+                                % (first, second))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
     # timeout requested case
     startTime = time.time()
     result = runTest(site, "timeout", 'Timeout Cached copy')
@@ -173,6 +533,12 @@ def runTests(site):
     assertEquals('CONFIG_FILE_ERROR="Exception updating config: <urlopen error timed out>"\n\nTimeout Cached copy', 
                  result, "timeout case")
 
+    # the cache file itself is left as it was, still expired
+    fp = open("cache_file")
+    if fp.read() != 'Timeout Cached copy' or os.path.getmtime("cache_file") > time.time() - 30:
+        raise TestError("Failed refresh should have left the cache file as it was")
+    fp.close()
+
     # re-run to make sure it works the second time without requesting
     startTime = time.time()
     result = run("python cache_config.py cache_file 30 30 %(site)s/%(test)s"
@@ -221,8 +587,13 @@ if __name__ == "__main__":
         status = 1
 
 
+    # remove the files the tests used, and the sidecar and lock files
+    # cache_config keeps next to them
     for k in opened_files.keys():
-        if os.path.exists(k):
-            os.remove(k)
+        for name in [k, k + ".meta", k + ".health", k + ".index", k + "_.lock", k + "_"]:
+            if os.path.isdir(name):
+                shutil.rmtree(name)
+            elif os.path.exists(name):
+                os.remove(name)
 
     sys.exit(status)
@@ -0,0 +1,20 @@
+import zlib
+
+BODY = "Compressed\nLine2"
+
+def get(request, response):
+
+    # send the config compressed with {encoding}: gzip, deflate (with a
+    # zlib header) or raw (deflate without one, as some servers send it)
+    encoding = request.attribute("encoding")
+
+    if encoding == "gzip":
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        encoding = "deflate"
+
+    response.setHeader("Content-Encoding", encoding)
+    response.write(compressor.compress(BODY) + compressor.flush(), "text/plain")
@@ -0,0 +1,2 @@
+def get(request, response):
+    response.write("Crlf\r\nLine2\r\n", "text/plain")
@@ -0,0 +1,43 @@
+import hashlib
+
+OLD = "A = 1\nB = 2\nC = 3\nD = 4\n"
+NEW = "A = 1\nB = two\nD = 4\nE = 5\n"
+
+# The changes from OLD to NEW, as "diff -e" writes them
+DELTA = "4a\nE = 5\n.\n2,3c\nB = two\n.\n"
+
+# The same config with CRLF line endings, and the changes as "diff -e"
+# writes them: its own lines end in newlines, the config's keep their CRLF
+CRLF_OLD   = OLD.replace("\n", "\r\n")
+CRLF_NEW   = NEW.replace("\n", "\r\n")
+CRLF_DELTA = "4a\nE = 5\r\n.\n2,3c\nB = two\r\n.\n"
+
+def get(request, response):
+
+    version = request.attribute("version")
+
+    if version == "old":
+        response.write(OLD, "text/plain")
+        return
+    if version == "crlf-old":
+        response.write(CRLF_OLD, "text/plain")
+        return
+
+    if version == "crlf-new":
+        old, new, delta = CRLF_OLD, CRLF_NEW, CRLF_DELTA
+    else:
+        old, new, delta = OLD, NEW, DELTA
+
+    # send just the changes to a client that has the old copy and can apply them
+    digest = request.header("X-Config-Digest")
+    accepted = request.header("A-IM") or ""
+    if digest == hashlib.sha1(old).hexdigest() and "diffe" in accepted:
+        response.setStatus(226)
+        response.setHeader("IM", "diffe")
+        response.setHeader("X-Config-Digest", hashlib.sha1(new).hexdigest())
+        response.write(delta, "text/plain")
+    elif version == "crlf-new":
+        # only the delta is served, so a full refetch shows up as an error
+        response.setStatus(500)
+    else:
+        response.write(new, "text/plain")
@@ -0,0 +1,10 @@
+import time
+
+def get(request, response):
+
+    # send the config a byte at a time, each well inside any read timeout,
+    # so that only a deadline can cut the request short
+    for c in "Drip success" * 10:
+        response.write(c, "text/plain")
+        response.flush()
+        time.sleep(0.3)
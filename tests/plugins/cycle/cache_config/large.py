@@ -0,0 +1,8 @@
+BODY = "Large = " + "x" * 100000
+
+def get(request, response):
+
+    # a body well past httplib's read buffer, on a connection the server
+    # closes once it is sent
+    response.setHeader("Connection", "close")
+    response.write(BODY, "text/plain")
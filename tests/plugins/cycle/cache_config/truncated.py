@@ -0,0 +1,22 @@
+import zlib
+
+BODY = "Truncated\nLine2"
+
+def get(request, response):
+
+    # send the config compressed with {encoding}, as compressed.py does, but
+    # with the last bytes of the compressed data missing, as when a
+    # connection is cut off
+    encoding = request.attribute("encoding")
+
+    if encoding == "gzip":
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        encoding = "deflate"
+
+    data = compressor.compress(BODY) + compressor.flush()
+    response.setHeader("Content-Encoding", encoding)
+    response.write(data[:-4], "text/plain")
@@ -0,0 +1,24 @@
+import time
+
+def get(request, response):
+
+    # a new version of the config is published every {period} seconds
+    period = int(request.attribute("period"))
+
+    reqTime = request.dateHeader("If-Modified-Since")
+    modTime = int(time.time() / period) * period
+
+    # hold the request open, when asked to, until the client's copy is out of date
+    prefer = request.header("Prefer") or ""
+    if prefer.startswith("wait=") and reqTime >= modTime:
+        wait = float(prefer[len("wait="):])
+        time.sleep(max(0, min(wait, modTime + period - time.time())))
+        modTime = int(time.time() / period) * period
+        response.setHeader("Preference-Applied", prefer)
+
+    if reqTime < modTime:
+        # the client's copy is out of date
+        response.setDateHeader("Last-Modified", modTime)
+        response.write("Version %d" % (modTime / period), "text/plain")
+    else:
+        response.setStatus(304)